@@ -0,0 +1,87 @@
+"""
+Compare the local HTML pipeline with server-side plain-text bodies.
+
+Runs both conversion paths over the fixture corpus in `fixtures/bodies`, where
+each `<name>.html` body has a `<name>.txt` counterpart in the format Graph
+returns with `Prefer: outlook.body-content-type="text"`.
+
+Usage: python -m benchmarks.body_conversion [--repeat 200]
+"""
+
+import argparse
+import difflib
+import re
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from lib.utils import process_html_to_text, process_plain_text
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "bodies"
+
+WORD_PATTERN = re.compile(r"\w+")
+URL_PATTERN = re.compile(r"https?://[^\s<>()\[\]]+")
+
+
+def load_fixtures() -> list[tuple[str, str, str]]:
+    return [
+        (path.stem, path.read_text(), path.with_suffix(".txt").read_text())
+        for path in sorted(FIXTURES_DIR.glob("*.html"))
+    ]
+
+
+def cpu_time(func: Callable[[str], str], bodies: list[str], repeat: int) -> float:
+    start = time.process_time()
+
+    for _ in range(repeat):
+        for body in bodies:
+            func(body)
+
+    return (time.process_time() - start) / repeat
+
+
+def compare(html_output: str, text_output: str) -> tuple[float, float]:
+    """Word similarity and link recall of the text path against the HTML path"""
+    html_words = WORD_PATTERN.findall(html_output.lower())
+    text_words = WORD_PATTERN.findall(text_output.lower())
+    similarity = difflib.SequenceMatcher(None, html_words, text_words).ratio()
+
+    html_links = set(URL_PATTERN.findall(html_output))
+    text_links = set(URL_PATTERN.findall(text_output))
+    link_recall = len(html_links & text_links) / len(html_links) if html_links else 1
+
+    return similarity, link_recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+
+    print(f"{'fixture':<16} {'html ms':>9} {'text ms':>9} {'words':>7} {'links':>7}")
+
+    for name, html, text in fixtures:
+        html_time = cpu_time(process_html_to_text, [html], args.repeat)
+        text_time = cpu_time(process_plain_text, [text], args.repeat)
+        similarity, link_recall = compare(
+            process_html_to_text(html), process_plain_text(text)
+        )
+
+        print(
+            f"{name:<16} {html_time * 1000:>9.3f} {text_time * 1000:>9.3f} "
+            f"{similarity:>7.1%} {link_recall:>7.1%}"
+        )
+
+    html_total = cpu_time(process_html_to_text, [f[1] for f in fixtures], args.repeat)
+    text_total = cpu_time(process_plain_text, [f[2] for f in fixtures], args.repeat)
+
+    print(
+        f"{'total':<16} {html_total * 1000:>9.3f} {text_total * 1000:>9.3f} "
+        f"(text path is {html_total / text_total:.0f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Count the Discord requests of each summary, packed against the previous splitter.
+
+The previous splitter sent every `##`/`###` section as its own message, split
+into 1900-char chunks with a 100-char overlap. The summaries in
+`fixtures/summaries` are packed into plain messages and into embeds, the
+requests of each are reported, and every payload is checked against the
+Discord limits.
+
+Usage: python -m benchmarks.discord_packing
+"""
+
+import argparse
+
+from benchmarks.markdown_splitter import FIXTURES_DIR, native_split
+from lib.utils import (
+    DISCORD_EMBED_DESCRIPTION_LIMIT,
+    DISCORD_EMBEDS_PER_MESSAGE,
+    DISCORD_EMBEDS_TOTAL_LIMIT,
+    DISCORD_MESSAGE_LIMIT,
+    pack_discord_embeds,
+    pack_discord_messages,
+)
+
+
+def within_limits(payload: dict) -> bool:
+    if "message" in payload:
+        return len(payload["message"]) <= DISCORD_MESSAGE_LIMIT
+
+    descriptions = [embed["description"] for embed in payload["embeds"]]
+
+    return (
+        len(descriptions) <= DISCORD_EMBEDS_PER_MESSAGE
+        and sum(map(len, descriptions)) <= DISCORD_EMBEDS_TOTAL_LIMIT
+        and all(len(text) <= DISCORD_EMBED_DESCRIPTION_LIMIT for text in descriptions)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args()
+
+    print(f"{'fixture':<16} {'previous':>9} {'messages':>9} {'embeds':>7} limits")
+
+    for path in sorted(FIXTURES_DIR.glob("*.md")):
+        text = path.read_text()
+        messages = pack_discord_messages(text)
+        embeds = pack_discord_embeds(text)
+        valid = all(within_limits(payload) for payload in messages + embeds)
+
+        print(
+            f"{path.stem:<16} {len(native_split(text)):>9} {len(messages):>9} "
+            f"{len(embeds):>7} {'ok' if valid else 'EXCEEDED'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare the size and load time of the email store formats.
+
+Builds a store of synthetic Graph message IDs checked over the retention period,
+then measures the serialised size, the time to save, and the time to load and
+prune it, for the flat JSON of earlier versions and the gzipped day buckets.
+
+Usage: python -m benchmarks.email_store [--entries 100000] [--repeat 5]
+"""
+
+import argparse
+import base64
+import functools
+import json
+import random
+import time
+from collections.abc import Callable
+from datetime import datetime, timedelta, timezone
+
+from lib.outlook.store import EmailStore, prune_email_store
+
+
+def generate_entries(count: int) -> dict[str, datetime]:
+    """Message IDs shaped like Graph IDs, checked evenly over the last 8 days"""
+    rng = random.Random(0)
+    now = datetime.now(timezone.utc)
+    prefix = rng.randbytes(64)
+
+    return {
+        # Graph IDs of a mailbox share a long prefix, followed by the item part
+        base64.urlsafe_b64encode(prefix + rng.randbytes(48)).decode(): now
+        - timedelta(seconds=rng.randrange(8 * 24 * 60 * 60))
+        for _ in range(count)
+    }
+
+
+def best_time(func: Callable[[], object], repeat: int) -> float:
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def save_legacy(entries: dict[str, datetime]) -> bytes:
+    # Same as the removed `save_store_with_datetime`
+    data = {key: value.astimezone().isoformat() for key, value in entries.items()}
+
+    return json.dumps(data).encode()
+
+
+def load_legacy(content: bytes) -> dict[str, datetime]:
+    # Same as `get_store_with_datetime` followed by `prune_email_store`
+    data = {
+        key: datetime.fromisoformat(value) for key, value in json.loads(content).items()
+    }
+
+    return prune_email_store(data)
+
+
+def load_store(content: bytes) -> EmailStore:
+    store = EmailStore.from_bytes(content)
+    store.prune()
+
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    entries = generate_entries(args.entries)
+    store = EmailStore.from_legacy(entries)
+
+    legacy_content = save_legacy(entries)
+    store_content = store.to_bytes()
+
+    lookups = list(entries)[:1000]
+
+    print(f"{args.entries} entries")
+    print(f"{'format':<10} {'size KiB':>10} {'save ms':>9} {'load ms':>9} {'kept':>7}")
+
+    for name, content, save, load in (
+        ("json", legacy_content, functools.partial(save_legacy, entries), load_legacy),
+        ("buckets", store_content, store.to_bytes, load_store),
+    ):
+        print(
+            f"{name:<10} {len(content) / 1024:>10.1f} "
+            f"{best_time(save, args.repeat) * 1000:>9.1f} "
+            f"{best_time(functools.partial(load, content), args.repeat) * 1000:>9.1f} "
+            f"{len(load(content)):>7}"
+        )
+
+    lookup_time = best_time(lambda: [key in store for key in lookups], args.repeat)
+    print(f"lookup: {lookup_time / len(lookups) * 1e6:.2f} us per ID")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+End-to-end benchmark of `summarize_outlook` against local fake servers.
+
+A synthetic mailbox is served by fake Graph, OpenAI-compatible and Discord
+servers, and `summarize_outlook` runs three times in fresh processes sharing one
+cache directory: a cold run over the whole mailbox, an incremental run after new
+mail arrived, and an idle run without new mail. Each run reports wall time, CPU
+time and peak RSS, and for each stage the calls, wall time, CPU time, the peak
+RSS reached by its end, and the HTTP requests and bytes the fake servers saw.
+
+Stages are timed by wrapping the functions doing their work once their modules
+are imported, so lazy imports stay lazy. Stages overlap, e.g. fetching the next
+page while a page is converted, and streamed summaries deliver while summarizing.
+
+Nothing leaves the machine, except the tiktoken encoding downloaded on the first
+run into `.cache/tiktoken` of the repository, or `TIKTOKEN_CACHE_DIR`. Offline,
+tokens are estimated from the text length instead, as the report shows.
+
+Usage: python -m benchmarks.end_to_end [--size 200] [--thread-depth 3] [--html-kib 20]
+    [--arrivals 10] [--llm-latency 0.5]
+"""
+
+import argparse
+import functools
+import importlib.abc
+import importlib.machinery
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+# Also runnable as `python benchmarks/end_to_end.py`, from any directory
+if str(REPOSITORY_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPOSITORY_ROOT))
+
+STAGES = (
+    "import",
+    "auth",
+    "store-load",
+    "list",
+    "fetch",
+    "replies",
+    "convert",
+    "summarize",
+    "deliver",
+    "store-save",
+)
+
+RUNS = ("cold", "incremental", "idle")
+
+
+class StageTimer:
+    """Calls, time intervals, CPU time and peak RSS of each stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[str, int] = defaultdict(int)
+        self.intervals: dict[str, list[tuple[float, float]]] = defaultdict(list)
+        self.cpu: dict[str, float] = defaultdict(float)
+        self.peak_rss: dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            cpu = time.thread_time() - cpu_start
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            with self.lock:
+                self.calls[name] += 1
+                self.intervals[name].append((start, end))
+                self.cpu[name] += cpu
+                self.peak_rss[name] = rss
+
+    def wrap(self, stage: str | Callable[..., str], func: Callable) -> Callable:
+        """Time `func` as the stage, or as the stage named by `stage(*args)`"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            name = stage(*args, **kwargs) if callable(stage) else stage
+
+            with self.stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def result(self) -> dict[str, dict]:
+        return {
+            name: {
+                "calls": self.calls[name],
+                "wall": covered_time(self.intervals[name]),
+                "cpu": self.cpu[name],
+                "peak_rss_kib": self.peak_rss[name],
+            }
+            for name in self.calls
+        }
+
+
+def covered_time(intervals: list[tuple[float, float]]) -> float:
+    """Time covered by the intervals, concurrent calls are counted once"""
+    total = 0.0
+    covered_until = float("-inf")
+
+    for start, end in sorted(intervals):
+        start = max(start, covered_until)
+
+        if end > start:
+            total += end - start
+            covered_until = end
+
+    return total
+
+
+class PatchFinder(importlib.abc.MetaPathFinder):
+    """Calls a patch on a module right after it is executed"""
+
+    def __init__(self, patches: dict[str, Callable]):
+        self.patches = patches
+
+    def find_spec(self, fullname, path, target=None):
+        patch = self.patches.get(fullname)
+
+        if patch is None:
+            return None
+
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            patch(module)
+
+        spec.loader.exec_module = exec_and_patch
+
+        return spec
+
+
+def batch_stage(api, batch_requests: list[dict]) -> str:
+    # Messages are fetched by ID, replies by listing their conversation
+    return (
+        "fetch" if batch_requests[0]["url"].startswith("/me/messages/") else "replies"
+    )
+
+
+def drive_stage(api, method="GET", *args, **kwargs) -> str:
+    return "store-load" if method == "GET" else "store-save"
+
+
+def stage_patches(timer: StageTimer) -> dict[str, Callable]:
+    def patch_microsoft(module):
+        api = module.MicrosoftGraphAPI
+        api.fetch_email_ids_delta = timer.wrap("list", api.fetch_email_ids_delta)
+        api._send_batch = timer.wrap(batch_stage, api._send_batch)
+        api.request_drive_content = timer.wrap(drive_stage, api.request_drive_content)
+
+    def patch_token(module):
+        provider = module.MicrosoftTokenProvider
+        provider.refresh = timer.wrap("auth", provider.refresh)
+
+    def patch_extractor(module):
+        extractor = module.EmailExtractor
+        extractor.build_emails = timer.wrap("convert", extractor.build_emails)
+
+    def patch_openai(module):
+        module.generate_schema = timer.wrap("summarize", module.generate_schema)
+        module.stream_schema = timer.wrap("summarize", module.stream_schema)
+
+    def patch_discord(module):
+        module.send_discord_webhook = timer.wrap("deliver", module.send_discord_webhook)
+
+    return {
+        "lib.api.microsoft": patch_microsoft,
+        "lib.api.microsoft_token": patch_token,
+        "lib.outlook.extractor": patch_extractor,
+        "lib.api.openai": patch_openai,
+        "lib.api.discord": patch_discord,
+    }
+
+
+def run_child(result_path: str):
+    """Run `summarize_outlook` once, with the environment set by the parent"""
+    timer = StageTimer()
+    sys.meta_path.insert(0, PatchFinder(stage_patches(timer)))
+
+    start = time.perf_counter()
+    error = None
+
+    with timer.stage("import"):
+        from lib.outlook.summarize import summarize_outlook
+
+    try:
+        summarize_outlook()
+    except Exception as e:
+        error = str(e)
+
+    # Only loaded by runs with new mail
+    prompt = sys.modules.get("lib.outlook.prompt")
+    encoding = None
+
+    if prompt is not None:
+        encoding = getattr(prompt.get_encoding(), "name", "character estimate")
+
+    result = {
+        "wall": time.perf_counter() - start,
+        "cpu": time.process_time(),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": timer.result(),
+        "encoding": encoding,
+        "error": error,
+    }
+
+    Path(result_path).write_text(json.dumps(result))
+
+
+def print_report(name: str, visible: int, result: dict, stats, discord_messages: int):
+    print(
+        f"\n{name}: {visible} emails in the inbox, wall {result['wall']:.2f} s, "
+        f"CPU {result['cpu']:.2f} s, peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB, "
+        f"{discord_messages} Discord messages"
+    )
+
+    if result["encoding"]:
+        print(f"  tokens counted with {result['encoding']}")
+
+    if result["error"]:
+        print(f"  run failed: {result['error']}")
+
+    print(
+        f"  {'stage':<12}{'calls':>7}{'wall s':>9}{'CPU s':>9}{'RSS MiB':>9}"
+        f"{'requests':>10}{'sent KiB':>10}{'recv KiB':>10}"
+    )
+
+    stages = result["stages"]
+    names = [stage for stage in STAGES if stage in stages or stage in stats.requests]
+    names += sorted(set(stats.requests) - set(STAGES))
+
+    for stage in names:
+        timing = stages.get(stage, {"calls": 0, "wall": 0, "cpu": 0, "peak_rss_kib": 0})
+        print(
+            f"  {stage:<12}{timing['calls']:>7}{timing['wall']:>9.3f}"
+            f"{timing['cpu']:>9.3f}{timing['peak_rss_kib'] / 1024:>9.1f}"
+            f"{stats.requests.get(stage, 0):>10}"
+            f"{stats.bytes_sent.get(stage, 0) / 1024:>10.1f}"
+            f"{stats.bytes_received.get(stage, 0) / 1024:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=200, help="Emails of the cold run")
+    parser.add_argument("--thread-depth", type=int, default=3)
+    parser.add_argument("--html-kib", type=float, default=20)
+    parser.add_argument(
+        "--arrivals", type=int, default=10, help="New emails before the incremental run"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.5, help="Seconds to the first token"
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    from benchmarks.fake_servers import (
+        FakeDiscordServer,
+        FakeGraphServer,
+        FakeOpenAIServer,
+        HttpStats,
+    )
+    from benchmarks.mailbox import generate_mailbox
+
+    mailbox = generate_mailbox(
+        args.size, args.thread_depth, args.html_kib, args.arrivals, args.seed
+    )
+
+    stats = HttpStats()
+    graph = FakeGraphServer(mailbox, stats)
+    openai = FakeOpenAIServer(stats, args.llm_latency, args.tokens_per_second)
+    discord = FakeDiscordServer(stats)
+
+    for server in (graph, openai, discord):
+        server.start()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = os.environ | {
+            "CACHE_DIR": cache_dir,
+            # Kept outside the temporary cache, so the encoding is downloaded once
+            "TIKTOKEN_CACHE_DIR": os.environ.get(
+                "TIKTOKEN_CACHE_DIR", str(REPOSITORY_ROOT / ".cache" / "tiktoken")
+            ),
+            "LOGURU_LEVEL": os.environ.get("LOGURU_LEVEL", "WARNING"),
+            "MICROSOFT_GRAPH_BASE_URL": graph.graph_url,
+            "MICROSOFT_TOKEN_URL": f"{graph.base_url}/token",
+            "MICROSOFT_CLIENT_ID": "benchmark",
+            "MICROSOFT_CLIENT_SECRET": "benchmark",
+            "MICROSOFT_REFRESH_TOKEN": "benchmark",
+            "OPENAI_API_BASE_URL": openai.api_url,
+            "OPENAI_API_KEY": "benchmark",
+            "DISCORD_WEBHOOK_EMAIL_INFO": discord.webhook_url("info"),
+            "DISCORD_WEBHOOK_EMAIL_EVENT": discord.webhook_url("event"),
+            "DISCORD_WEBHOOK_EMAIL_PROGRAM": discord.webhook_url("program"),
+        }
+        result_path = os.path.join(cache_dir, "result.json")
+
+        for name in RUNS:
+            if name == "incremental":
+                mailbox.deliver(args.arrivals)
+
+            stats.reset()
+            delivered = sum(map(len, discord.messages.values()))
+
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.end_to_end", "--child", result_path],
+                env=env,
+                cwd=REPOSITORY_ROOT,
+                check=True,
+            )
+
+            result = json.loads(Path(result_path).read_text())
+            delivered = sum(map(len, discord.messages.values())) - delivered
+
+            print_report(name, len(mailbox.visible()), result, stats, delivered)
+
+    for server in (graph, openai, discord):
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Send Graph-style validation requests and change notifications to a receiver.
+
+Without `--url`, a `NotificationReceiver` is started on a free local port. The
+script checks that validation tokens are echoed, that a wrong client state is
+rejected, and reports the latency from sending a notification to its message
+ID being queued. With `--url` and `--client-state`, the notifications go to a
+running daemon instead. Its client state is set with
+`GRAPH_NOTIFICATION_CLIENT_STATE`, and each notification starts a cycle.
+
+Usage: python -m benchmarks.fake_notifier [--count 200] [--url URL --client-state STATE]
+"""
+
+import argparse
+import secrets
+import statistics
+import threading
+import time
+import uuid
+
+import requests
+
+from lib.outlook.notifications import INBOX_RESOURCE, NotificationReceiver
+
+
+def notification_body(client_state: str, message_ids: list[str]) -> dict:
+    """A change notification of new messages, as Graph sends it"""
+    return {
+        "value": [
+            {
+                "subscriptionId": str(uuid.uuid4()),
+                "clientState": client_state,
+                "changeType": "created",
+                "resource": f"{INBOX_RESOURCE}/{message_id}",
+                "subscriptionExpirationDateTime": "2030-01-01T00:00:00Z",
+                "tenantId": str(uuid.uuid4()),
+                "resourceData": {
+                    "@odata.type": "#Microsoft.Graph.Message",
+                    "@odata.id": f"Users/me/Messages/{message_id}",
+                    "id": message_id,
+                },
+            }
+            for message_id in message_ids
+        ]
+    }
+
+
+def check(name: str, passed: bool):
+    print(f"{name:<40} {'ok' if passed else 'FAILED'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--url", help="Notification URL of a running daemon")
+    parser.add_argument("--client-state", default=secrets.token_urlsafe(32))
+    args = parser.parse_args()
+
+    receiver = None
+    queued = threading.Event()
+
+    if args.url is None:
+        receiver = NotificationReceiver(
+            port=0,
+            client_state=args.client_state,
+            on_notification=queued.set,
+            host="127.0.0.1",
+        )
+        receiver.start()
+        args.url = f"http://127.0.0.1:{receiver.port}/"
+
+    session = requests.Session()
+
+    token = secrets.token_urlsafe(16)
+    response = session.post(args.url, params={"validationToken": token}, timeout=5)
+    check("validation token echoed", response.text == token)
+
+    response = session.post(
+        args.url, json=notification_body("wrong", ["rejected"]), timeout=5
+    )
+    check("wrong client state rejected", response.status_code == 403)
+
+    response = session.post(args.url, data=b"not json", timeout=5)
+    check("malformed body rejected", response.status_code == 400)
+
+    latencies = []
+
+    for index in range(args.count):
+        queued.clear()
+        start = time.perf_counter()
+
+        response = session.post(
+            args.url,
+            json=notification_body(args.client_state, [f"message-{index}"]),
+            timeout=5,
+        )
+
+        if receiver is not None:
+            queued.wait(timeout=5)
+
+        latencies.append(time.perf_counter() - start)
+
+        if response.status_code != 202:
+            check(f"notification {index} accepted", False)
+            break
+
+    if receiver is not None:
+        message_ids = receiver.drain()
+        check(
+            f"{args.count} message IDs queued in order",
+            message_ids == [f"message-{index}" for index in range(args.count)],
+        )
+        receiver.stop()
+
+    print(
+        f"latency: median {statistics.median(latencies) * 1000:.2f} ms, "
+        f"max {max(latencies) * 1000:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
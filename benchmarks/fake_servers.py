@@ -0,0 +1,463 @@
+"""
+Local stand-ins for Microsoft Graph, an OpenAI-compatible API and Discord webhooks.
+
+Each server answers the requests the app sends with data of a synthetic
+`Mailbox`, keeps connections alive like the real APIs, and counts requests and
+bytes by the stage of a run they belong to.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+from benchmarks.mailbox import WORDS, Mailbox, graph_message
+
+TEXT_BODY_PREFER = 'outlook.body-content-type="text"'
+
+
+class HttpStats:
+    """Requests and bytes of each stage, updated by the server threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests: dict[str, int] = defaultdict(int)
+        self.bytes_sent: dict[str, int] = defaultdict(int)
+        self.bytes_received: dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, bytes_sent: int, bytes_received: int):
+        """Sent by the app, received by the app"""
+        with self.lock:
+            self.requests[stage] += 1
+            self.bytes_sent[stage] += bytes_sent
+            self.bytes_received[stage] += bytes_received
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection pooling is measured like with the real APIs
+    protocol_version = "HTTP/1.1"
+    server: "FakeServer"
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send(
+        self,
+        stage: str,
+        status: int,
+        body: bytes = b"",
+        headers: dict[str, str] | None = None,
+        request_size: int = 0,
+    ):
+        self.send_response(status)
+
+        for name, value in {
+            "Content-Type": "application/json",
+            **(headers or {}),
+        }.items():
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        self.server.stats.record(stage, request_size, len(body))
+
+    def send_json(self, stage: str, status: int, data, request_size: int = 0, **kwargs):
+        self.send(
+            stage,
+            status,
+            json.dumps(data).encode(),
+            request_size=request_size,
+            **kwargs,
+        )
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler: type[FakeHandler], stats: HttpStats):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.stats = stats
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class GraphHandler(FakeHandler):
+    """Graph endpoints used by `MicrosoftGraphAPI`, and the token endpoint"""
+
+    server: "FakeGraphServer"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path.startswith("/v1.0/me/drive/root:"):
+            self.get_drive_content(url.path)
+            return
+
+        stage, status, data = self.server.get(self.path, self.headers.get("Prefer", ""))
+        self.send_json(stage, status, data)
+
+    def do_POST(self):
+        body = self.read_body()
+
+        if self.path == "/token":
+            token = {
+                "access_token": "fake-access-token",
+                "expires_in": 3600,
+                "refresh_token": "fake-refresh-token",
+            }
+            self.send_json("auth", 200, token, request_size=len(body))
+            return
+
+        if self.path == "/v1.0/$batch":
+            requests = json.loads(body)["requests"]
+            responses = []
+            stage = "fetch"
+
+            for request in requests:
+                prefer = (request.get("headers") or {}).get("Prefer", "")
+                stage, status, data = self.server.get(f"/v1.0{request['url']}", prefer)
+                responses.append(
+                    {"id": request["id"], "status": status, "headers": {}, "body": data}
+                )
+
+            self.send_json(stage, 200, {"responses": responses}, request_size=len(body))
+            return
+
+        self.send_json(
+            "other", 404, {"error": {"code": "NotFound"}}, request_size=len(body)
+        )
+
+    def do_PUT(self):
+        body = self.read_body()
+        path = urlparse(self.path).path
+
+        with self.server.lock:
+            self.server.version += 1
+            etag = f'"{{FAKE}},{self.server.version}"'
+            self.server.drive[path] = (etag, body)
+
+        self.send_json(
+            "store-save", 201, {"id": path, "eTag": etag}, request_size=len(body)
+        )
+
+    def get_drive_content(self, path: str):
+        with self.server.lock:
+            item = self.server.drive.get(path)
+
+        if item is None:
+            self.send_json("store-load", 404, {"error": {"code": "itemNotFound"}})
+        elif self.headers.get("If-None-Match") == item[0]:
+            self.send("store-load", 304, headers={"ETag": item[0]})
+        else:
+            self.send(
+                "store-load",
+                200,
+                item[1],
+                headers={"ETag": item[0], "Content-Type": "application/octet-stream"},
+            )
+
+
+class FakeGraphServer(FakeServer):
+    def __init__(self, mailbox: Mailbox, stats: HttpStats):
+        super().__init__(GraphHandler, stats)
+        self.mailbox = mailbox
+        self.lock = threading.Lock()
+        self.drive: dict[str, tuple[str, bytes]] = {}
+        self.version = 0
+
+    @property
+    def graph_url(self) -> str:
+        return f"{self.base_url}/v1.0"
+
+    def get(self, path: str, prefer: str) -> tuple[str, int, dict]:
+        """
+        Answer a GET request, sent directly or inside a $batch.
+
+        Returns:
+            tuple[str, int, dict]: The stage, the status and the JSON body.
+        """
+        url = urlparse(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body_type = "text" if TEXT_BODY_PREFER in prefer else "html"
+
+        if url.path == "/v1.0/me/mailFolders/inbox":
+            return "list", 200, {"id": "inbox"}
+
+        if url.path == "/v1.0/me/mailFolders/inbox/messages/delta":
+            return "list", 200, self.delta_page(query, prefer)
+
+        if url.path == "/v1.0/me/mailFolders/inbox/messages":
+            conversation_filter = query.get("$filter", "")
+
+            if "conversationId eq" in conversation_filter:
+                conversation_id = conversation_filter.split("'")[1]
+                replies = [
+                    graph_message(message, body_type)
+                    for message in self.mailbox.conversation(conversation_id)
+                ]
+                return "replies", 200, {"value": replies}
+
+            return "list", 200, self.list_page(query)
+
+        if url.path.startswith("/v1.0/me/messages/"):
+            message = self.mailbox.get(unquote(url.path.rsplit("/", 1)[1]))
+
+            if message is None:
+                return "fetch", 404, {"error": {"code": "ErrorItemNotFound"}}
+
+            return "fetch", 200, graph_message(message, body_type)
+
+        return "other", 404, {"error": {"code": "NotFound"}}
+
+    def delta_page(self, query: dict[str, str], prefer: str) -> dict:
+        # Messages delivered after the delta token, in pages of the preferred size
+        start = int(query.get("$deltatoken", 0))
+        offset = int(query.get("$skiptoken", start))
+        page_size = 100
+
+        if "odata.maxpagesize=" in prefer:
+            page_size = int(prefer.split("odata.maxpagesize=")[1].split(",")[0])
+
+        visible = self.mailbox.visible()
+        page = visible[offset : offset + page_size]
+        data = {
+            "value": [
+                {"id": message["id"], "receivedDateTime": message["receivedDateTime"]}
+                for message in page
+            ]
+        }
+        url = f"{self.graph_url}/me/mailFolders/inbox/messages/delta"
+
+        if offset + page_size < len(visible):
+            data["@odata.nextLink"] = f"{url}?$skiptoken={offset + page_size}"
+        else:
+            data["@odata.deltaLink"] = f"{url}?$deltatoken={len(visible)}"
+
+        return data
+
+    def list_page(self, query: dict[str, str]) -> dict:
+        # Newest first, like the `$orderby` of the time-window listing
+        top = int(query.get("$top", 10))
+        skip = int(query.get("$skip", 0))
+        selected = set(query.get("$select", "").split(",")) | {"id"}
+
+        messages = self.mailbox.visible()[::-1]
+        data = {
+            "value": [
+                {key: value for key, value in message.items() if key in selected}
+                for message in messages[skip : skip + top]
+            ]
+        }
+
+        if skip + top < len(messages):
+            next_query = {**query, "$skip": str(skip + top)}
+            data["@odata.nextLink"] = (
+                f"{self.graph_url}/me/mailFolders/inbox/messages?"
+                + urlencode(next_query)
+            )
+
+        return data
+
+
+class OpenAIHandler(FakeHandler):
+    """Chat completions with structured output, streamed or not"""
+
+    server: "FakeOpenAIServer"
+
+    def do_POST(self):
+        body = self.read_body()
+        request = json.loads(body)
+
+        schema = request["response_format"]["json_schema"]["schema"]
+        prompt = "".join(str(message["content"]) for message in request["messages"])
+        content = json.dumps(self.server.complete(schema, prompt))
+
+        completion = {
+            "id": "chatcmpl-fake",
+            "created": int(time.time()),
+            "model": request["model"],
+        }
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt) + len(content)) // 4,
+        }
+
+        time.sleep(self.server.first_token_latency)
+
+        if not request.get("stream"):
+            time.sleep(len(content) / 4 / self.server.tokens_per_second)
+
+            completion |= {
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": usage,
+            }
+            self.send_json("summarize", 200, completion, request_size=len(body))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        sent = 0
+        chunk_size = 16
+
+        for start in range(0, len(content) + 1, chunk_size):
+            last = start + chunk_size > len(content)
+            delta = {"content": content[start : start + chunk_size]}
+            chunk = completion | {
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {} if last and not delta["content"] else delta,
+                        "finish_reason": "stop" if last else None,
+                    }
+                ],
+            }
+            sent += self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(chunk_size / 4 / self.server.tokens_per_second)
+
+        sent += self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+        self.server.stats.record("summarize", len(body), sent)
+
+    def write_chunk(self, data: bytes) -> int:
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+        return len(data)
+
+
+class FakeOpenAIServer(FakeServer):
+    def __init__(
+        self,
+        stats: HttpStats,
+        first_token_latency: float = 0.5,
+        tokens_per_second: float = 200,
+    ):
+        super().__init__(OpenAIHandler, stats)
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.base_url}/v1"
+
+    @staticmethod
+    def complete(schema: dict, prompt: str) -> dict:
+        """Answer matching the schema, longer for longer prompts"""
+        rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+        # More sections for prompts of more emails, as long as real summaries
+        sections = max(1, min(prompt.count("Subject:"), 8))
+
+        def text(words: int) -> str:
+            return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+        def bullets(count: int) -> str:
+            return "\n".join(f"- {text(rng.randint(10, 25))}." for _ in range(count))
+
+        answer = {}
+
+        for name, prop in schema["properties"].items():
+            if prop.get("type") == "boolean":
+                answer[name] = True
+            elif "enum" in prop:
+                answer[name] = rng.choice(prop["enum"])
+            elif name == "title":
+                answer[name] = text(5)
+            elif name.endswith("_summary"):
+                answer[name] = "\n\n".join(
+                    f"## {text(4)}\n\n{bullets(2)}"
+                    for _ in range(rng.randint(0, sections))
+                )
+            else:
+                answer[name] = bullets(rng.randint(2, 5))
+
+        return answer
+
+
+class DiscordHandler(FakeHandler):
+    """Webhooks limited like Discord, 5 requests per 2 seconds each"""
+
+    server: "FakeDiscordServer"
+
+    def do_POST(self):
+        body = self.read_body()
+        webhook = urlparse(self.path).path
+        now = time.monotonic()
+
+        with self.server.lock:
+            window = [
+                sent_at
+                for sent_at in self.server.windows[webhook]
+                if now - sent_at < self.server.window_seconds
+            ]
+            allowed = len(window) < self.server.window_limit
+
+            if allowed:
+                window.append(now)
+                self.server.messages[webhook].append(json.loads(body))
+
+            self.server.windows[webhook] = window
+
+        reset_after = self.server.window_seconds - (now - window[0])
+        headers = {
+            "X-RateLimit-Bucket": hashlib.md5(webhook.encode()).hexdigest(),
+            "X-RateLimit-Limit": str(self.server.window_limit),
+            "X-RateLimit-Remaining": str(self.server.window_limit - len(window)),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+
+        if allowed:
+            self.send("deliver", 204, headers=headers, request_size=len(body))
+        else:
+            error = {
+                "message": "You are being rate limited.",
+                "retry_after": reset_after,
+                "global": False,
+            }
+            self.send_json(
+                "deliver", 429, error, request_size=len(body), headers=headers
+            )
+
+
+class FakeDiscordServer(FakeServer):
+    def __init__(
+        self, stats: HttpStats, window_limit: int = 5, window_seconds: float = 2
+    ):
+        super().__init__(DiscordHandler, stats)
+        self.lock = threading.Lock()
+        self.window_limit = window_limit
+        self.window_seconds = window_seconds
+        self.windows: dict[str, list[float]] = defaultdict(list)
+        self.messages: dict[str, list[dict]] = defaultdict(list)
+
+    def webhook_url(self, name: str) -> str:
+        return f"{self.base_url}/api/webhooks/{name}/fake-token"
@@ -0,0 +1,96 @@
+"""
+Report the import cost of the entry point, and the modules of each run path.
+
+Runs `python -X importtime` in a fresh interpreter for `main`, which is all a run
+without new mail loads, and for the modules only loaded once there is new mail.
+The import time of the slowest top-level packages is listed for each, summed
+over their submodules.
+
+Usage: python -m benchmarks.import_time [--top 10] [--output benchmarks/import_time.txt]
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# Cold start of every run, then the modules loaded on the first new email
+TARGETS = {
+    "main": "main",
+    "new mail": "main, lib.outlook.summarizer, lib.api.discord, openai, html2text",
+}
+
+# Modules that must stay out of a run without new mail
+HEAVY_MODULES = ("openai", "tiktoken", "html2text", "lib.api.discord", "pydantic")
+
+
+def import_time(modules: str) -> tuple[dict[str, int], list[str]]:
+    """
+    Import modules in a fresh interpreter with `-X importtime`.
+
+    Args:
+        modules (str): The import statement targets, e.g. `main, openai`.
+
+    Returns:
+        tuple[dict[str, int], list[str]]: The cumulative microseconds of each
+            top-level import, and the heavy modules that were loaded.
+    """
+    code = (
+        f"import sys; import {modules}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    packages: dict[str, int] = {}
+
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        self_time, _, name = line.removeprefix("import time:").split("|")
+
+        # Self times do not overlap, so they add up per package
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_time)
+
+    heavy = [module for module in result.stdout.strip().split(",") if module]
+
+    return packages, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    lines = [f"Python {sys.version.split()[0]}, `-X importtime` self time per package"]
+
+    for label, modules in TARGETS.items():
+        packages, heavy = import_time(modules)
+        total = sum(packages.values())
+
+        lines.append("")
+        lines.append(f"{label}: {total / 1000:.1f} ms (import {modules})")
+        lines.append(f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[: args.top]
+
+        for package, time in slowest:
+            lines.append(f"  {time / 1000:>8.1f} ms  {package}")
+
+    report = "\n".join(lines)
+    print(report)
+
+    if args.output:
+        args.output.write_text(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Synthetic Outlook mailboxes for the end-to-end benchmark.
+
+Messages have the shape Graph returns for the `$select` of `MicrosoftGraphAPI`,
+with long base64 IDs, threads of replies sharing a conversation, and HTML bodies
+padded with the markup and Safe Links of real university mailing lists.
+"""
+
+import base64
+import html
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
+WORDS = (
+    "course assignment deadline lecture exam registration seminar workshop "
+    "scholarship internship library campus student faculty department office "
+    "application program research project schedule update reminder important "
+    "please note submit online portal session venue room building hall week"
+).split()
+
+SAFE_LINK = (
+    "https://nam12.safelinks.protection.outlook.com/?url={url}"
+    "&data=05%7C02%7Cstudent%40example.edu%7C{token}&reserved=0"
+)
+
+
+@dataclass
+class Mailbox:
+    """
+    Messages of an inbox, delivered in order.
+
+    Only the first `delivered` messages are visible, `deliver` makes more of them
+    arrive, so a later run has new mail.
+    """
+
+    messages: list[dict]
+    delivered: int
+    positions: dict[str, int] = field(init=False)
+
+    def __post_init__(self):
+        self.positions = {
+            message["id"]: index for index, message in enumerate(self.messages)
+        }
+
+    def visible(self) -> list[dict]:
+        return self.messages[: self.delivered]
+
+    def get(self, message_id: str) -> dict | None:
+        """The message, if it was delivered"""
+        index = self.positions.get(message_id)
+
+        if index is None or index >= self.delivered:
+            return None
+
+        return self.messages[index]
+
+    def deliver(self, count: int):
+        self.delivered = min(self.delivered + count, len(self.messages))
+
+    def conversation(self, conversation_id: str) -> list[dict]:
+        return [
+            message
+            for message in self.visible()
+            if message["conversationId"] == conversation_id
+        ]
+
+
+def sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+
+def html_body(rng: random.Random, paragraphs: list[str], size: int) -> str:
+    """HTML of a newsletter-like email, padded with markup to about `size` bytes"""
+    parts = [
+        "<html><head><style>p{margin:0} .x{color:#333}</style></head><body>",
+        '<table role="presentation" width="100%" cellpadding="0"><tr><td>',
+    ]
+
+    for paragraph in paragraphs:
+        url = f"https://www.example.edu/{rng.choice(WORDS)}/{rng.randrange(10**6)}"
+        link = SAFE_LINK.format(
+            url=quote(url, safe=""),
+            token=base64.b64encode(rng.randbytes(24)).decode(),
+        )
+        parts.append(
+            f'<p class="x" style="font-family:Calibri,sans-serif;font-size:11pt">'
+            f'{html.escape(paragraph)} <a href="{html.escape(link)}">Details</a></p>'
+        )
+
+    # Layout markup of mailing list templates, without any text
+    while sum(map(len, parts)) < size:
+        parts.append(
+            '<div style="mso-line-height-rule:exactly;line-height:1px">'
+            '<span style="font-size:1px">&nbsp;</span></div>'
+        )
+
+    parts.append("</td></tr></table></body></html>")
+
+    return "".join(parts)
+
+
+def generate_mailbox(
+    size: int,
+    thread_depth: int = 3,
+    html_kib: float = 20,
+    arrivals: int = 0,
+    seed: int = 0,
+) -> Mailbox:
+    """
+    Generate a mailbox.
+
+    Args:
+        size (int): Number of messages visible before the first run.
+        thread_depth (int): Maximum number of messages in a conversation.
+        html_kib (float): Size of each HTML body, mostly markup.
+        arrivals (int): Extra messages delivered later by `Mailbox.deliver`.
+        seed (int): Seed of the generator, the same arguments give the same mailbox.
+
+    Returns:
+        Mailbox: The messages, oldest first.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    total = size + arrivals
+
+    # Graph IDs of a mailbox share a long prefix, followed by the item part
+    prefix = rng.randbytes(64)
+    messages: list[dict] = []
+    open_threads: list[tuple[str, str, int]] = []
+
+    for index in range(total):
+        reply_to = None
+
+        if open_threads and rng.random() < 0.4:
+            reply_to = rng.choice(open_threads)
+
+        if reply_to is None:
+            conversation_id = base64.b64encode(rng.randbytes(48)).decode()
+            topic = sentence(rng, rng.randint(3, 8)).rstrip(".")
+            depth = 1
+            subject = topic
+        else:
+            open_threads.remove(reply_to)
+            conversation_id, topic, depth = reply_to
+            depth += 1
+            subject = f"RE: {topic}"
+
+        # Threads take replies until they reach the depth
+        if depth < thread_depth:
+            open_threads.append((conversation_id, topic, depth))
+
+        paragraphs = [
+            sentence(rng, rng.randint(12, 40)) for _ in range(rng.randint(2, 6))
+        ]
+        received = now - timedelta(hours=48) * (total - index) / total
+
+        message = {
+            "id": base64.urlsafe_b64encode(prefix + rng.randbytes(48)).decode(),
+            "conversationId": conversation_id,
+            "changeKey": base64.b64encode(rng.randbytes(12)).decode(),
+            "subject": subject,
+            "sender": {
+                "emailAddress": {
+                    "name": f"{rng.choice(WORDS).title()} Office",
+                    "address": f"{rng.choice(WORDS)}@example.edu",
+                }
+            },
+            "receivedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "html": html_body(rng, paragraphs, int(html_kib * 1024)),
+            "text": "\r\n\r\n".join(paragraphs),
+        }
+
+        # Only replies carry the In-Reply-To header the extractor expands
+        if reply_to is not None:
+            message["singleValueExtendedProperties"] = [
+                {"id": "String 0x1042", "value": f"<{index}@example.edu>"}
+            ]
+
+        messages.append(message)
+
+    return Mailbox(messages, delivered=size)
+
+
+def graph_message(message: dict, body_type: str) -> dict:
+    """The message as Graph returns it, with the body in the preferred type"""
+    result = {
+        key: value for key, value in message.items() if key not in ("html", "text")
+    }
+    result["uniqueBody"] = {"contentType": body_type, "content": message[body_type]}
+
+    return result
@@ -0,0 +1,114 @@
+"""
+Compare the native markdown splitter with the langchain splitters it replaces.
+
+Splits the summaries in `fixtures/summaries` the way Discord delivery did, into
+`##`/`###` sections and then 1900-char chunks with a 100-char overlap. The
+outputs are checked to be identical, and the time per summary and the import
+cost of both implementations are reported. The langchain columns need
+`langchain_text_splitters`, which is no longer a dependency.
+
+Usage: python -m benchmarks.markdown_splitter [--repeat 500]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from lib.utils import split_markdown_sections, split_text
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "summaries"
+
+
+def native_split(text: str) -> list[str]:
+    return [
+        chunk
+        for section in split_markdown_sections(text)
+        for chunk in split_text(section, chunk_size=1900, chunk_overlap=100)
+    ]
+
+
+def langchain_split(text: str) -> list[str]:
+    # Same construction as the previous `split_text_and_send_to_discord`
+    from langchain_text_splitters import (
+        MarkdownHeaderTextSplitter,
+        RecursiveCharacterTextSplitter,
+    )
+
+    markdown_splitter = MarkdownHeaderTextSplitter(
+        strip_headers=False,
+        headers_to_split_on=[("##", "Header 2"), ("###", "Header 3")],
+    )
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1900, chunk_overlap=100)
+    documents = text_splitter.split_documents(markdown_splitter.split_text(text))
+
+    return [document.page_content for document in documents]
+
+
+def cpu_time(func: Callable[[str], list[str]], text: str, repeat: int) -> float:
+    start = time.process_time()
+
+    for _ in range(repeat):
+        func(text)
+
+    return (time.process_time() - start) / repeat
+
+
+def import_time(module: str) -> float:
+    """Wall time to import a module in a fresh interpreter, in seconds"""
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    return float(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    try:
+        import langchain_text_splitters  # noqa: F401
+    except ImportError:
+        has_langchain = False
+    else:
+        has_langchain = True
+
+    print(f"{'fixture':<16} {'chunks':>7} {'native ms':>10} {'langchain ms':>13} same")
+
+    for path in sorted(FIXTURES_DIR.glob("*.md")):
+        text = path.read_text()
+        chunks = native_split(text)
+        native_time = cpu_time(native_split, text, args.repeat)
+
+        if has_langchain:
+            langchain_time = (
+                f"{cpu_time(langchain_split, text, args.repeat) * 1000:>13.3f}"
+            )
+            same = "yes" if langchain_split(text) == chunks else "NO"
+        else:
+            langchain_time, same = f"{'-':>13}", "-"
+
+        print(
+            f"{path.stem:<16} {len(chunks):>7} {native_time * 1000:>10.3f} "
+            f"{langchain_time} {same}"
+        )
+
+    print(f"import lib.utils {import_time('lib.utils') * 1000:>8.1f} ms")
+
+    if has_langchain:
+        print(
+            f"import langchain_text_splitters "
+            f"{import_time('langchain_text_splitters') * 1000:>8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
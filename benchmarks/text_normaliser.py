@@ -0,0 +1,121 @@
+"""
+Scaling of the text normaliser against the previous three-pass implementation.
+
+Bodies are built from long lines with plain links, markdown links, Safe Links
+and blank lines, like minified newsletters after HTML conversion. Linear code
+keeps a constant time per KiB as the body grows. The links of `FIXTURES` are
+checked first, e.g. URLs with parentheses and link texts with brackets.
+
+Usage: python -m benchmarks.text_normaliser [--max-kib 256]
+"""
+
+import argparse
+import re
+import time
+import urllib.parse
+
+from lib.utils import normalize_text
+
+# Text and its expected normalisation with wrapped links
+FIXTURES = (
+    (
+        "See [Mercury](https://en.wikipedia.org/wiki/Mercury_(planet)) tonight",
+        "See [Mercury](<https://en.wikipedia.org/wiki/Mercury_(planet)>) tonight",
+    ),
+    (
+        "Cited in [[1]](https://example.com/refs#1) and [a [b] c](https://example.com)",
+        "Cited in [[1]](<https://example.com/refs#1>) and [a [b] c](<https://example.com>)",
+    ),
+    (
+        "[Form](https://nam12.safelinks.protection.outlook.com/?url=https%3A%2F%2F"
+        "example.com%2Fa_(b)&data=0)\n \nAlready [wrapped](<https://example.com>)",
+        "[Form](<https://example.com/a_(b)>)\nAlready [wrapped](<https://example.com>)",
+    ),
+)
+
+LEGACY_SAFE_LINK_PATTERN = (
+    r"https?:\/\/.*safelinks\.protection\.outlook\.com\/\\?.*[?&]url=([^&]*)&"
+)
+
+
+def legacy_normalize(text: str) -> str:
+    """The implementation replaced by `normalize_text`, kept for comparison"""
+    text = "\n".join([line for line in text.split("\n") if line.strip()])
+    text = re.sub(
+        LEGACY_SAFE_LINK_PATTERN,
+        lambda m: urllib.parse.unquote(m.group(1)),
+        text,
+    )
+
+    import re as _re
+
+    return _re.sub(
+        r"(\[.*?\]\()(.*?)(\))",
+        lambda m: f"{m.group(1)}<{m.group(2)}>{m.group(3)}",
+        text,
+    )
+
+
+def make_body(size: int) -> str:
+    """A body of about `size` bytes, each line growing with the body"""
+    plain_segment = (
+        "Read more at https://example.com/news/item?id=42 or the [event page]"
+        "(https://example.com/events/7) for details, [[1]]"
+        "(https://en.wikipedia.org/wiki/Mercury_(planet)). "
+    )
+    safelink_segment = (
+        "Register at https://nam12.safelinks.protection.outlook.com/?url=https%3A%2F%2F"
+        "forms.example.com%2Fr%2Fabc&data=05%7C02%7C%7C0&sdata=x%3D&reserved=0 now. "
+    )
+    repeat = max(1, size // ((len(plain_segment) + len(safelink_segment)) * 2))
+
+    # Lines without any Safe Link make the legacy pattern backtrack from every URL
+    lines = [plain_segment * repeat, safelink_segment * repeat] * 2
+
+    return "\n \n".join(lines)
+
+
+def best_time(func, text: str, repeat: int = 3) -> float:
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--max-kib", type=int, default=256)
+    args = parser.parse_args()
+
+    for text, expected in FIXTURES:
+        result = normalize_text(text, wrap_links=True)
+
+        if result != expected:
+            raise Exception(f"Normalised {text!r} to {result!r}, expected {expected!r}")
+
+    print(f"{len(FIXTURES)} fixtures normalised as expected\n")
+    print(f"{'KiB':>6} {'legacy ms':>10} {'ms/KiB':>8} {'new ms':>8} {'ms/KiB':>8}")
+
+    size_kib = 8
+
+    while size_kib <= args.max_kib:
+        body = make_body(size_kib * 1024)
+        kib = len(body) / 1024
+
+        legacy = best_time(legacy_normalize, body)
+        new = best_time(lambda text: normalize_text(text, wrap_links=True), body)
+
+        print(
+            f"{kib:>6.0f} {legacy * 1000:>10.2f} {legacy * 1000 / kib:>8.3f} "
+            f"{new * 1000:>8.2f} {new * 1000 / kib:>8.3f}"
+        )
+
+        size_kib *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,122 @@
-from datetime import datetime, timedelta
-from time import sleep
+import threading
+import time
+from dataclasses import dataclass, replace
 
 import requests
-from cachetools import TTLCache
 from loguru import logger
 
-cache = TTLCache(maxsize=10, ttl=60)
+from lib.api.http import RETRY_STATUS_CODES, create_session, http_policy
 
+# Rate limits and server errors are retried here, rate limits with the precise
+# `retry_after` of Discord
+session = create_session(replace(http_policy, max_retries=0))
 
-def get_cooldown_status():
-    return {
-        "required": cache.get("required", False),
-        "expiry": cache.get("expiry", datetime.now()),
-    }
 
+@dataclass
+class RateLimitBucket:
+    remaining: int = 1
+    # time.monotonic() when the bucket is refilled
+    reset_at: float = 0.0
 
-def set_cooldown_status(required: bool, expiry: datetime):
-    cache["required"] = required
-    cache["expiry"] = expiry
+
+class DiscordRateLimiter:
+    """
+    Discord rate limits, tracked per bucket and per webhook.
+
+    Webhooks start with their own bucket until Discord reports the
+    `X-RateLimit-Bucket` they belong to. Only the requests of an exhausted bucket
+    wait, a global limit makes every request wait.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bucket_keys: dict[str, str] = {}
+        self.buckets: dict[str, RateLimitBucket] = {}
+        self.global_reset_at = 0.0
+
+    @staticmethod
+    def webhook_key(webhook_url: str) -> str:
+        # The same webhook with other query parameters shares the limits
+        return webhook_url.split("?")[0]
+
+    def get_bucket(self, webhook_url: str) -> RateLimitBucket:
+        webhook = self.webhook_key(webhook_url)
+        key = self.bucket_keys.get(webhook, webhook)
+
+        return self.buckets.setdefault(key, RateLimitBucket())
+
+    def wait(self, webhook_url: str):
+        """Block the calling thread until a request to the webhook is allowed"""
+        while True:
+            with self.lock:
+                bucket = self.get_bucket(webhook_url)
+                now = time.monotonic()
+
+                delay = self.global_reset_at - now
+
+                if bucket.remaining <= 0:
+                    delay = max(delay, bucket.reset_at - now)
+
+            if delay <= 0:
+                return
+
+            logger.debug(f"Discord ratelimit reached, sleeping for {delay:.2f}s")
+            time.sleep(delay)
+
+    def update(self, webhook_url: str, response):
+        """Record the limits reported by a response"""
+        headers = response.headers
+        now = time.monotonic()
+
+        with self.lock:
+            bucket_hash = headers.get("X-RateLimit-Bucket")
+
+            if bucket_hash is not None:
+                webhook = self.webhook_key(webhook_url)
+                # Buckets are shared by routes, but limited per webhook
+                self.bucket_keys[webhook] = f"{bucket_hash}:{webhook}"
+
+            bucket = self.get_bucket(webhook_url)
+
+            if response.status_code == 429:
+                try:
+                    body = response.json() if response.content else {}
+                except ValueError:
+                    # e.g. an HTML error page of Cloudflare, only headers are left
+                    body = {}
+
+                if not isinstance(body, dict):
+                    body = {}
+
+                retry_after = http_policy.retry_delay(
+                    body.get(
+                        "retry_after",
+                        headers.get(
+                            "Retry-After", headers.get("X-RateLimit-Reset-After")
+                        ),
+                    ),
+                    attempt=1,
+                )
+
+                if body.get("global") or headers.get("X-RateLimit-Global"):
+                    self.global_reset_at = now + retry_after
+                else:
+                    bucket.remaining = 0
+                    bucket.reset_at = now + retry_after
+
+                return
+
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = headers.get("X-RateLimit-Reset-After")
+
+            if remaining is None or reset_after is None:
+                return
+
+            bucket.remaining = int(remaining)
+            bucket.reset_at = now + float(reset_after)
+
+
+rate_limiter = DiscordRateLimiter()
 
 
 def send_discord_webhook(
@@ -25,43 +124,55 @@ def send_discord_webhook(
     message: str | None = None,
     embed: dict | None = None,
     username="School",
+    embeds: list[dict] | None = None,
 ):
-    now = datetime.now()
-    status = get_cooldown_status()
+    data = {"content": message, "username": username}
 
-    if status["required"] and (status["expiry"] > now):
-        seconds_left: timedelta = status["expiry"] - now
-        seconds_left = seconds_left.total_seconds()
+    if embed is not None:
+        data["embeds"] = [embed]
 
-        logger.debug(f"Discord ratelimit reached, sleeping for {seconds_left}s")
+    if embeds is not None:
+        data["embeds"] = embeds
 
-        # Sleep for the remaining cooldown time
-        sleep(seconds_left)
+    attempts = http_policy.max_retries + 1
 
-        # Reset the cooldown status
-        set_cooldown_status(False, datetime.now())
+    for attempt in range(1, attempts + 1):
+        rate_limiter.wait(webhook_url)
 
-    data = {"content": message, "username": username}
+        # Send the message to the Discord webhook
+        try:
+            response = session.post(webhook_url, json=data)
+        except requests.ConnectionError:
+            # A refused or reset connection, the next run would send it again anyway
+            if attempt == attempts:
+                raise
 
-    if embed is not None:
-        data["embeds"] = [embed]
+            delay = http_policy.retry_delay(None, attempt)
+            logger.warning(
+                f"Discord webhook connection failed, attempt {attempt}, "
+                f"retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+            continue
+
+        rate_limiter.update(webhook_url, response)
 
-    # Send the message to the Discord webhook
-    response = requests.post(webhook_url, json=data)
+        if response.status_code == 429:
+            logger.warning(f"Discord webhook rate limited, attempt {attempt}")
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+            break
+
+        delay = http_policy.retry_delay(response.headers.get("Retry-After"), attempt)
+        logger.warning(
+            f"Discord webhook failed {response.status_code}, attempt {attempt}, "
+            f"retrying in {delay:.1f}s"
+        )
+        time.sleep(delay)
 
     if response.status_code != 204:
         raise ValueError(
             f"Discord webhook request failed {response.status_code}",
             response.text,
         )
-
-    # Check X-RateLimit-Limit and X-RateLimit-Remaining headers
-    remaining = response.headers.get("X-RateLimit-Remaining")
-    reset_after = response.headers.get("X-RateLimit-Reset-After")
-
-    if remaining is None or reset_after is None:
-        return
-
-    if int(remaining) == 1:
-        expiry = now + timedelta(seconds=float(reset_after))
-        set_cooldown_status(required=True, expiry=expiry)
@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib.env import getenv
+
+# Throttled (429) and transient server errors worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+@dataclass(frozen=True)
+class HttpPolicy:
+    """Connection pooling, timeout and retry policy shared by all HTTP clients"""
+
+    connect_timeout: float
+    read_timeout: float
+    pool_connections: int
+    pool_maxsize: int
+    max_retries: int
+    backoff_factor: float
+    max_retry_after: float
+
+    @classmethod
+    def from_env(cls) -> "HttpPolicy":
+        return cls(
+            connect_timeout=float(getenv("HTTP_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(getenv("HTTP_READ_TIMEOUT", "30")),
+            pool_connections=int(getenv("HTTP_POOL_CONNECTIONS", "4")),
+            pool_maxsize=int(getenv("HTTP_POOL_MAXSIZE", "20")),
+            max_retries=int(getenv("HTTP_MAX_RETRIES", "5")),
+            backoff_factor=float(getenv("HTTP_BACKOFF_FACTOR", "1")),
+            max_retry_after=float(getenv("HTTP_MAX_RETRY_AFTER", "120")),
+        )
+
+    def retry_delay(self, retry_after: str | None, attempt: int) -> float:
+        """
+        Seconds to wait before retrying, honouring a Retry-After header if present.
+
+        Args:
+            retry_after (str | None): Value of the Retry-After header, in seconds.
+            attempt (int): Number of attempts made so far, starting from 1.
+
+        Returns:
+            float: The delay, capped at `max_retry_after`.
+        """
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.backoff_factor * (2 ** (attempt - 1))
+
+        return min(delay, self.max_retry_after)
+
+
+http_policy = HttpPolicy.from_env()
+
+
+class PolicyRetry(Retry):
+    """urllib3 retries with the Retry-After header capped by the policy"""
+
+    def __init__(self, *args, max_retry_after: float | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_retry_after = max_retry_after
+
+    def new(self, **kwargs) -> "PolicyRetry":
+        retry = super().new(**kwargs)
+        retry.max_retry_after = self.max_retry_after
+
+        return retry
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+
+        if retry_after is None or self.max_retry_after is None:
+            return retry_after
+
+        return min(retry_after, self.max_retry_after)
+
+
+class PolicyHTTPAdapter(HTTPAdapter):
+    """HTTP adapter applying the default timeout of the policy to every request"""
+
+    def __init__(self, policy: HttpPolicy):
+        self.policy = policy
+
+        super().__init__(
+            pool_connections=policy.pool_connections,
+            pool_maxsize=policy.pool_maxsize,
+            max_retries=PolicyRetry(
+                total=policy.max_retries,
+                backoff_factor=policy.backoff_factor,
+                status_forcelist=RETRY_STATUS_CODES,
+                # Only idempotent methods, a POST or PATCH may have been applied
+                # before the error. Graph $batch requests are retried by the caller.
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                respect_retry_after_header=True,
+                max_retry_after=policy.max_retry_after,
+                raise_on_status=False,
+            ),
+        )
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (self.policy.connect_timeout, self.policy.read_timeout)
+
+        return super().send(request, **kwargs)
+
+
+def create_session(policy: HttpPolicy = http_policy) -> requests.Session:
+    """
+    Create a session with a keep-alive connection pool and retries on throttling.
+
+    Args:
+        policy (HttpPolicy): The pooling, timeout and retry policy.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    session = requests.Session()
+    adapter = PolicyHTTPAdapter(policy)
+
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
@@ -1,53 +1,57 @@
+import time
+from collections.abc import Iterable, Iterator
 from datetime import datetime, timedelta
 from functools import cache
+from urllib.parse import quote, urlencode
 
 import requests
+from loguru import logger
 from pytz import timezone
 
+from lib.api.http import RETRY_STATUS_CODES, create_session, http_policy
+from lib.api.microsoft_token import MicrosoftAuth, token_provider
 from lib.env import getenv
 
+# Maximum number of sub-requests accepted by a single JSON $batch call
+GRAPH_BATCH_LIMIT = 20
 
-class MicrosoftGraphAPI:
-    def __init__(self):
-        self.ms_base_url = "https://graph.microsoft.com/v1.0"
-        self.access_token = self.get_access_token()
+EMAIL_SELECT = "sender,subject,receivedDateTime,uniqueBody,conversationId,changeKey"
+EMAIL_EXPAND = "SingleValueExtendedProperties($filter=(Id eq 'String 0x1042'))"
 
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json",
-            }
-        )
 
-    @cache
-    def get_access_token(self) -> str:
-        client_id = getenv("MICROSOFT_CLIENT_ID")
-        client_secret = getenv("MICROSOFT_CLIENT_SECRET")
-        refresh_token = getenv("MICROSOFT_REFRESH_TOKEN")
+class DeltaTokenExpiredError(Exception):
+    """Raised when Graph no longer accepts a saved delta link (410 Gone)"""
 
-        if not refresh_token or not client_id or not client_secret:
-            raise Exception(
-                "Microsoft refresh token, client ID, or client secret is not set"
-            )
 
-        MSFT_REDIRECT_URI = "http://localhost:53682"
-        url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+@cache
+def get_graph_session() -> requests.Session:
+    """Connection pool shared by all Graph API clients of the process"""
+    session = create_session()
+    session.auth = MicrosoftAuth()
+    session.headers.update({"Content-Type": "application/json"})
 
-        payload = {
-            "grant_type": "refresh_token",
-            "REDIRECT_URL": MSFT_REDIRECT_URI,
-            "CLIENT_ID": client_id,
-            "CLIENT_SECRET": client_secret,
-            "refresh_token": refresh_token,
-        }
+    return session
 
-        response = requests.post(url, data=payload, timeout=5)
 
-        if response.status_code != 200:
-            raise Exception("Error getting Microsoft access token: " + response.text)
+class MicrosoftGraphAPI:
+    def __init__(self, body_type: str = "html"):
+        """
+        Args:
+            body_type: Content type of requested message bodies, `html` or `text`.
+                With `text`, Graph converts the bodies on the server side.
+        """
+        self.ms_base_url = getenv(
+            "MICROSOFT_GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0"
+        )
+        self.session = get_graph_session()
+
+        self.body_headers = {}
 
-        return response.json()["access_token"]
+        if body_type == "text":
+            self.body_headers["Prefer"] = 'outlook.body-content-type="text"'
+
+    def get_access_token(self) -> str:
+        return token_provider.get_access_token()
 
     def get_inbox_folder_id(self):
         url = f"{self.ms_base_url}/me/mailFolders/inbox"
@@ -59,67 +63,271 @@ class MicrosoftGraphAPI:
 
         return response.json()["id"]
 
-    def fetch_replies(self, conversation_id: str) -> list[dict]:
-        url = f"{self.ms_base_url}/me/mailFolders/inbox/messages"
-
-        params = [
+    @staticmethod
+    def _replies_params(conversation_id: str) -> list[tuple[str, str]]:
+        return [
             ("$top", "50"),
-            ("$select", "sender,subject,receivedDateTime,uniqueBody"),
+            ("$select", "sender,subject,receivedDateTime,uniqueBody,changeKey"),
             ("$filter", f"conversationId eq '{conversation_id}'"),
         ]
 
-        response = self.session.get(url, params=params)
+    def _send_batch(self, batch_requests: list[dict]) -> list[dict]:
+        """Send up to 20 Graph requests through one JSON $batch call
 
-        if response.status_code != 200:
-            raise Exception("Error fetching email replies")
+        Args:
+            batch_requests: GET sub-requests with a `url` relative to the API version,
+                a throttled batch is sent again as a whole
+
+        Returns:
+            list[dict]: Sub-responses (`status`, `headers`, `body`), in the same order as the requests
+        """
+        url = f"{self.ms_base_url}/$batch"
+        results: dict[int, dict] = {}
+        pending = list(range(len(batch_requests)))
+
+        for attempt in range(1, http_policy.max_retries + 2):
+            payload = {
+                "requests": [
+                    {"id": str(index), **batch_requests[index]} for index in pending
+                ]
+            }
+
+            response = self.session.post(url, json=payload)
+
+            # Only GET requests are batched, so a throttled batch is safe to repeat
+            if (
+                response.status_code in RETRY_STATUS_CODES
+                and attempt <= http_policy.max_retries
+            ):
+                delay = http_policy.retry_delay(
+                    response.headers.get("Retry-After"), attempt
+                )
+                logger.debug(
+                    f"Batch request failed with {response.status_code}, "
+                    f"retrying in {delay}s"
+                )
+                time.sleep(delay)
+                continue
+
+            if response.status_code != 200:
+                raise Exception(f"Error sending batch request: {response.text}")
+
+            # Sub-requests are throttled individually, retry only those
+            throttled: list[int] = []
+            delay = 0.0
+
+            for item in response.json()["responses"]:
+                index = int(item["id"])
+                results[index] = item
+
+                if item["status"] in RETRY_STATUS_CODES:
+                    throttled.append(index)
+                    retry_after = (item.get("headers") or {}).get("Retry-After")
+                    delay = max(delay, http_policy.retry_delay(retry_after, attempt))
+
+            if not throttled or attempt > http_policy.max_retries:
+                break
+
+            logger.debug(
+                f"{len(throttled)} batch requests throttled, retrying in {delay}s"
+            )
+            time.sleep(delay)
+
+            pending = sorted(throttled)
 
-        data: list[dict] = response.json()["value"]
-        data.sort(key=lambda x: x["receivedDateTime"], reverse=True)
+        # Sub-responses are not guaranteed to come back in request order
+        return [results[index] for index in range(len(batch_requests))]
 
-        return data
+    def replies_batch_requests(self, conversation_ids: list[str]) -> list[dict]:
+        return [
+            {
+                "method": "GET",
+                "url": "/me/mailFolders/inbox/messages?"
+                + urlencode(
+                    self._replies_params(conversation_id), safe="$'", quote_via=quote
+                ),
+                "headers": self.body_headers,
+            }
+            for conversation_id in conversation_ids
+        ]
+
+    @staticmethod
+    def parse_replies_batch(
+        conversation_ids: list[str], responses: list[dict]
+    ) -> dict[str, list[dict]]:
+        replies: dict[str, list[dict]] = {}
 
-    def fetch_emails(self) -> list[dict]:
-        inbox_id = self.get_inbox_folder_id()
+        for conversation_id, response in zip(conversation_ids, responses, strict=True):
+            if response["status"] != 200:
+                raise Exception("Error fetching email replies")
 
-        url = f"{self.ms_base_url}/me/mailFolders/{inbox_id}/messages"
+            data: list[dict] = response["body"]["value"]
+            data.sort(key=lambda x: x["receivedDateTime"], reverse=True)
 
+            replies[conversation_id] = data
+
+        return replies
+
+    @staticmethod
+    def _received_cutoff() -> datetime:
         date_filter_yesterday = datetime.now() - timedelta(days=3)
         date_filter_yesterday = date_filter_yesterday.replace(
             tzinfo=timezone("Asia/Hong_Kong")
         )
 
+        return date_filter_yesterday
+
+    @classmethod
+    def _received_since(cls) -> str:
+        return cls._received_cutoff().isoformat()
+
+    @classmethod
+    def _is_in_window(cls, message: dict) -> bool:
+        received = message.get("receivedDateTime")
+
+        # Kept when Graph leaves the property out, the email store still filters it
+        if not received:
+            return True
+
+        return datetime.fromisoformat(received) >= cls._received_cutoff()
+
+    def _iter_pages(
+        self, url: str, params: list[tuple[str, str]], headers: dict | None = None
+    ) -> Iterator[list]:
+        while url:
+            response = self.session.get(url, params=params, headers=headers)
+
+            if response.status_code != 200:
+                raise Exception("Error fetching emails")
+
+            data = response.json()
+
+            yield data["value"]
+
+            # Next links already carry the query parameters
+            url = data.get("@odata.nextLink")
+            params = None
+
+    def iter_email_metadata_pages(self, page_size: int = 50) -> Iterator[list[dict]]:
+        """Lazily iterate inbox messages of the time window without their bodies
+
+        Args:
+            page_size: Number of messages requested per page
+
+        Yields:
+            list[dict]: A page of messages with `id`, `conversationId` and `receivedDateTime` only
+        """
+        # The well-known folder name saves a round trip for the inbox folder ID
+        url = f"{self.ms_base_url}/me/mailFolders/inbox/messages"
+
         params = [
-            ("$top", "250"),
-            ("$select", "sender,subject,receivedDateTime,uniqueBody,conversationId"),
+            ("$top", str(page_size)),
+            ("$select", "conversationId,receivedDateTime"),
             ("$orderby", "receivedDateTime desc"),
-            ("$filter", f"receivedDateTime ge {date_filter_yesterday.isoformat()}"),
-            (
-                "$expand",
-                "SingleValueExtendedProperties($filter=(Id eq 'String 0x1042'))",
-            ),
+            ("$filter", f"receivedDateTime ge {self._received_since()}"),
         ]
 
-        response = self.session.get(url, params=params)
+        return self._iter_pages(url, params)
 
-        if response.status_code != 200:
-            raise Exception("Error fetching emails")
+    def fetch_email_ids_delta(
+        self, delta_link: str | None = None
+    ) -> tuple[list[str], str]:
+        """Fetch the IDs of inbox messages added or changed since a delta link
 
-        return response.json()["value"]
+        Args:
+            delta_link: Delta link saved by the previous run, a new delta round over
+                the time window is started when missing
 
-    def request_drive_content(self, method="GET", path="", data=None):
-        url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{path}:/content"
+        Returns:
+            tuple[list[str], str]: Changed message IDs and the delta link for the next run
+        """
+        # The filter only applies to the first round, later rounds return any
+        # changed message, e.g. an old email marked as read
+
+        if delta_link is None:
+            url = f"{self.ms_base_url}/me/mailFolders/inbox/messages/delta"
+            params = [
+                ("$select", "receivedDateTime"),
+                ("$filter", f"receivedDateTime ge {self._received_since()}"),
+            ]
+        else:
+            url = delta_link
+            params = None
+
+        message_ids: list[str] = []
+
+        while True:
+            response = self.session.get(
+                url, params=params, headers={"Prefer": "odata.maxpagesize=100"}
+            )
 
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+            if response.status_code == 410:
+                raise DeltaTokenExpiredError("Delta link is expired")
+
+            if response.status_code != 200:
+                raise Exception(f"Error fetching email changes: {response.text}")
+
+            data = response.json()
+
+            # Deleted or moved messages are not needed, nor emails older than the
+            # time window, which the email store no longer remembers
+            message_ids.extend(
+                message["id"]
+                for message in data["value"]
+                if "@removed" not in message and self._is_in_window(message)
+            )
+
+            if "@odata.nextLink" not in data:
+                return message_ids, data["@odata.deltaLink"]
+
+            # Next links already carry the query parameters
+            url = data["@odata.nextLink"]
+            params = None
+
+    def emails_batch_requests(self, message_ids: Iterable[str]) -> list[dict]:
+        query = urlencode(
+            [("$select", EMAIL_SELECT), ("$expand", EMAIL_EXPAND)],
+            safe="$'",
+            quote_via=quote,
+        )
+
+        return [
+            {
+                "method": "GET",
+                "url": f"/me/messages/{quote(message_id, safe='')}?{query}",
+                "headers": self.body_headers,
+            }
+            for message_id in dict.fromkeys(message_ids)
+        ]
+
+    @staticmethod
+    def parse_emails_batch(responses: list[dict]) -> list[dict]:
+        emails: list[dict] = []
+
+        for response in responses:
+            # The message may have been deleted after the delta round
+            if response["status"] == 404:
+                continue
+
+            if response["status"] != 200:
+                raise Exception("Error fetching emails")
+
+            emails.append(response["body"])
+
+        emails.sort(key=lambda x: x["receivedDateTime"], reverse=True)
+
+        return emails
+
+    def request_drive_content(
+        self, method="GET", path="", data=None, headers: dict | None = None
+    ):
+        url = f"{self.ms_base_url}/me/drive/root:/{path}:/content"
 
         response = self.session.request(
             method,
             url,
-            headers=headers,
+            headers={"Accept": "application/json", **(headers or {})},
             data=data,
-            timeout=10,
         )
 
         return response
@@ -205,3 +413,81 @@ class MicrosoftGraphAPI:
 
         # Simplify task data structure
         return response.json().get("value", [])
+
+    def create_subscription(
+        self,
+        resource: str,
+        notification_url: str,
+        expiration: datetime,
+        client_state: str,
+        change_type: str = "created",
+    ) -> dict:
+        """Subscribe to change notifications of a resource
+
+        Graph validates `notification_url` before answering, so the receiver
+        must already be listening.
+
+        Args:
+            resource: The resource path, e.g. `me/mailFolders('inbox')/messages`
+            notification_url: Public HTTPS URL of the notification receiver
+            expiration: Time the subscription expires, at most 7 days for messages
+            client_state: Secret sent back with every notification
+            change_type: Comma separated changes to be notified of
+
+        Returns:
+            dict: Created subscription data
+        """
+        url = f"{self.ms_base_url}/subscriptions"
+
+        subscription_data = {
+            "changeType": change_type,
+            "notificationUrl": notification_url,
+            "resource": resource,
+            "expirationDateTime": expiration.isoformat(),
+            "clientState": client_state,
+        }
+
+        response = self.session.post(url, json=subscription_data)
+
+        if response.status_code != 201:
+            raise Exception(f"Error creating subscription: {response.text}")
+
+        return response.json()
+
+    def renew_subscription(self, subscription_id: str, expiration: datetime) -> dict:
+        """Extend the expiration of a subscription
+
+        Returns:
+            dict: Updated subscription data, empty if the subscription no longer exists
+        """
+        url = f"{self.ms_base_url}/subscriptions/{subscription_id}"
+
+        response = self.session.patch(
+            url, json={"expirationDateTime": expiration.isoformat()}
+        )
+
+        if response.status_code == 404:
+            return {}
+
+        if response.status_code != 200:
+            raise Exception(f"Error renewing subscription: {response.text}")
+
+        return response.json()
+
+    def delete_subscription(self, subscription_id: str):
+        url = f"{self.ms_base_url}/subscriptions/{subscription_id}"
+
+        response = self.session.delete(url)
+
+        if response.status_code not in (204, 404):
+            raise Exception(f"Error deleting subscription: {response.text}")
+
+    def list_subscriptions(self) -> list[dict]:
+        url = f"{self.ms_base_url}/subscriptions"
+
+        response = self.session.get(url)
+
+        if response.status_code != 200:
+            raise Exception(f"Error listing subscriptions: {response.text}")
+
+        return response.json().get("value", [])
@@ -0,0 +1,74 @@
+import asyncio
+from collections.abc import Callable, Iterable
+
+from lib.api.microsoft import GRAPH_BATCH_LIMIT, MicrosoftGraphAPI
+from lib.env import getenv
+
+
+class AsyncMicrosoftGraphAPI:
+    """
+    Asyncio counterpart of MicrosoftGraphAPI.
+
+    Requests run in worker threads over the shared Graph connection pool, at most
+    `max_concurrency` at a time, so independent requests overlap.
+    """
+
+    def __init__(
+        self, api: MicrosoftGraphAPI | None = None, max_concurrency: int | None = None
+    ):
+        self.api = api or MicrosoftGraphAPI()
+
+        if max_concurrency is None:
+            # Outlook allows 4 concurrent requests per app and mailbox
+            max_concurrency = int(getenv("GRAPH_MAX_CONCURRENCY", "4"))
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def batch(self, batch_requests: list[dict]) -> list[dict]:
+        """Send $batch calls of up to 20 requests concurrently, keeping the order"""
+        chunks = await asyncio.gather(
+            *(
+                self.run(
+                    self.api._send_batch,
+                    batch_requests[start : start + GRAPH_BATCH_LIMIT],
+                )
+                for start in range(0, len(batch_requests), GRAPH_BATCH_LIMIT)
+            )
+        )
+
+        return [response for chunk in chunks for response in chunk]
+
+    async def fetch_replies_batch(
+        self, conversation_ids: Iterable[str]
+    ) -> dict[str, list[dict]]:
+        """Fetch the replies of many conversations with $batch requests
+
+        Args:
+            conversation_ids: Conversation IDs, duplicates are only fetched once
+
+        Returns:
+            dict[str, list[dict]]: Replies of each conversation, newest first
+        """
+        # Keep the order while removing duplicated conversations
+        unique_ids = list(dict.fromkeys(conversation_ids))
+
+        responses = await self.batch(self.api.replies_batch_requests(unique_ids))
+
+        return self.api.parse_replies_batch(unique_ids, responses)
+
+    async def fetch_emails_by_id(self, message_ids: Iterable[str]) -> list[dict]:
+        """Fetch full messages by ID with $batch requests
+
+        Args:
+            message_ids: IDs of the messages, duplicates are only fetched once
+
+        Returns:
+            list[dict]: Messages with their unique body, newest first
+        """
+        responses = await self.batch(self.api.emails_batch_requests(message_ids))
+
+        return self.api.parse_emails_batch(responses)
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+
+import requests
+from loguru import logger
+from requests.auth import AuthBase
+
+from lib.api.http import create_session
+from lib.cache import get_cache_path
+from lib.env import getenv
+
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+
+
+class MicrosoftTokenProvider:
+    """
+    Process-wide Microsoft access token, cached on disk with its expiry.
+
+    The rotated refresh token is cached as well, so the next process can reuse
+    the access token or refresh it without the one from the environment.
+    """
+
+    def __init__(self, cache_name: str = "microsoft_token.json"):
+        self.cache_name = cache_name
+        self.lock = threading.Lock()
+        self.token: dict | None = None
+        self.session = create_session()
+
+    def load_cache(self) -> dict | None:
+        path = get_cache_path(self.cache_name)
+
+        if not path.exists():
+            return None
+
+        try:
+            token = json.loads(path.read_text())
+        except (OSError, ValueError):
+            logger.warning("Microsoft token cache is unreadable, ignoring it")
+            return None
+
+        # Ignore tokens issued to another application
+        if token.get("client_id") != getenv("MICROSOFT_CLIENT_ID"):
+            return None
+
+        return token
+
+    def save_cache(self, token: dict):
+        path = get_cache_path(self.cache_name)
+
+        # The cache holds credentials, only the owner may read it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with os.fdopen(fd, "w") as f:
+            json.dump(token, f)
+
+    def request_token(self, refresh_token: str) -> requests.Response:
+        client_id = getenv("MICROSOFT_CLIENT_ID")
+        client_secret = getenv("MICROSOFT_CLIENT_SECRET")
+
+        MSFT_REDIRECT_URI = "http://localhost:53682"
+        url = getenv(
+            "MICROSOFT_TOKEN_URL",
+            "https://login.microsoftonline.com/common/oauth2/v2.0/token",
+        )
+
+        payload = {
+            "grant_type": "refresh_token",
+            "REDIRECT_URL": MSFT_REDIRECT_URI,
+            "CLIENT_ID": client_id,
+            "CLIENT_SECRET": client_secret,
+            "refresh_token": refresh_token,
+        }
+
+        return self.session.post(url, data=payload)
+
+    def refresh(self, cached: dict | None) -> dict:
+        client_id = getenv("MICROSOFT_CLIENT_ID")
+        client_secret = getenv("MICROSOFT_CLIENT_SECRET")
+        refresh_token = getenv("MICROSOFT_REFRESH_TOKEN")
+
+        if not refresh_token or not client_id or not client_secret:
+            raise Exception(
+                "Microsoft refresh token, client ID, or client secret is not set"
+            )
+
+        response = None
+
+        # Prefer the rotated refresh token of the previous run
+        if cached and cached.get("refresh_token"):
+            response = self.request_token(cached["refresh_token"])
+
+            if response.status_code != 200:
+                logger.warning("Cached Microsoft refresh token was rejected")
+
+        if response is None or response.status_code != 200:
+            response = self.request_token(refresh_token)
+
+        if response.status_code != 200:
+            raise Exception("Error getting Microsoft access token: " + response.text)
+
+        data = response.json()
+
+        token = {
+            "client_id": client_id,
+            "access_token": data["access_token"],
+            "expires_at": time.time() + int(data.get("expires_in", 3600)),
+            # Not every response rotates the refresh token
+            "refresh_token": data.get(
+                "refresh_token", (cached or {}).get("refresh_token")
+            ),
+        }
+
+        self.save_cache(token)
+        logger.debug("Refreshed Microsoft access token")
+
+        return token
+
+    def is_fresh(self, token: dict | None) -> bool:
+        if token is None:
+            return False
+
+        return token["expires_at"] - TOKEN_REFRESH_MARGIN > time.time()
+
+    def get_access_token(self) -> str:
+        with self.lock:
+            if self.token is None:
+                self.token = self.load_cache()
+
+            if not self.is_fresh(self.token):
+                self.token = self.refresh(self.token)
+
+            return self.token["access_token"]
+
+
+token_provider = MicrosoftTokenProvider()
+
+
+class MicrosoftAuth(AuthBase):
+    """Attach the shared access token to every request, refreshing it when due"""
+
+    def __call__(self, request: requests.PreparedRequest) -> requests.PreparedRequest:
+        request.headers["Authorization"] = f"Bearer {token_provider.get_access_token()}"
+
+        return request
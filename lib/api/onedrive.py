@@ -1,45 +1,191 @@
+import hashlib
 import json
+import os
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
 
 from loguru import logger
 
 from lib.api.microsoft import MicrosoftGraphAPI
+from lib.cache import get_cache_path
 
 ONEDRIVE_STORE_FOLDER = "Data"
 
 
-def get_store(path: str) -> dict[str, str]:
-    default = {}
+@dataclass
+class StoreTransferStats:
+    """Traffic of the store files in this run, updated by concurrent threads"""
+
+    hits: int = 0
+    misses: int = 0
+    skipped_writes: int = 0
+    bytes_downloaded: int = 0
+    bytes_uploaded: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **counts: int):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+store_stats = StoreTransferStats()
+
+
+def log_store_stats():
+    logger.info(
+        f"OneDrive store: {store_stats.hits} hits, {store_stats.misses} misses, "
+        f"{store_stats.skipped_writes} unchanged writes skipped, "
+        f"{store_stats.bytes_downloaded} bytes downloaded, "
+        f"{store_stats.bytes_uploaded} bytes uploaded"
+    )
+
+
+class StoreMirror:
+    """
+    Local copy of a store file, with the eTag of the OneDrive version it matches.
+
+    The content is written before its metadata, a mirror whose content does not
+    match the recorded hash is ignored, so an interrupted write is never trusted.
+    """
+
+    def __init__(self, path: str):
+        name = path.replace("/", "_")
+        self.content_path = get_cache_path(f"onedrive_{name}")
+        self.meta_path = get_cache_path(f"onedrive_{name}.meta.json")
+
+    @staticmethod
+    def content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def load(self) -> tuple[str, bytes] | None:
+        """
+        Returns:
+            tuple[str, bytes] | None: The eTag and the content, if the mirror is intact.
+        """
+        try:
+            meta = json.loads(self.meta_path.read_text())
+            content = self.content_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("etag") is None or meta.get("sha256") != self.content_hash(content):
+            return None
+
+        return meta["etag"], content
+
+    def save(self, etag: str | None, content: bytes):
+        write_atomic(self.content_path, content)
+        write_atomic(
+            self.meta_path,
+            json.dumps({"etag": etag, "sha256": self.content_hash(content)}).encode(),
+        )
+
+    def clear(self):
+        self.meta_path.unlink(missing_ok=True)
+        self.content_path.unlink(missing_ok=True)
+
+
+def write_atomic(path: Path, content: bytes):
+    temp_path = path.with_name(f"{path.name}.tmp")
+    temp_path.write_bytes(content)
+    os.replace(temp_path, path)
+
+
+def get_store_content(path: str) -> bytes | None:
+    """
+    Download a store file, or read it from the mirror if it is unchanged.
+
+    Args:
+        path (str): The path of the file in the store folder.
+
+    Returns:
+        bytes | None: The content of the file, or None if it does not exist.
+    """
+    mirror = StoreMirror(path)
+    mirrored = mirror.load()
+
+    # An unchanged store is answered with 304 Not Modified and read from the mirror
+    headers = {"If-None-Match": mirrored[0]} if mirrored else None
 
     response = MicrosoftGraphAPI().request_drive_content(
-        method="GET", path=f"{ONEDRIVE_STORE_FOLDER}/{path}"
+        method="GET", path=f"{ONEDRIVE_STORE_FOLDER}/{path}", headers=headers
     )
 
+    if response.status_code == 304 and mirrored:
+        store_stats.add(hits=1)
+        logger.debug(f"Store file not modified: {path}, loaded from the mirror")
+        return mirrored[1]
+
+    store_stats.add(misses=1, bytes_downloaded=len(response.content))
+
     if response.status_code == 404:
-        logger.debug(f"Store file not found: {path}, returning default")
-        return default
+        # The next save must upload, even if it matches the deleted content
+        mirror.clear()
+        logger.debug(f"Store file not found: {path}")
+        return None
 
     if response.status_code >= 300:
         raise Exception(f"Error getting store file: {response.text}")
 
+    mirror.save(response.headers.get("ETag"), response.content)
+
     logger.debug(f"Loaded store file: {path}")
 
-    return response.json()
+    return response.content
 
 
-def save_store(path: str, d: dict | list):
+def save_store_content(path: str, data: bytes, content_type: str = "application/json"):
+    """
+    Upload a store file, unless the mirror shows it is unchanged.
+
+    Args:
+        path (str): The path of the file in the store folder.
+        data (bytes): The new content of the file.
+        content_type (str): The media type of the content.
+    """
+    mirror = StoreMirror(path)
+    mirrored = mirror.load()
+
+    # The mirror holds what was last read or written, skip uploading the same content
+    if mirrored and mirror.content_hash(mirrored[1]) == mirror.content_hash(data):
+        store_stats.add(skipped_writes=1)
+        logger.debug(f"Store file unchanged: {path}, upload skipped")
+        return
+
     response = MicrosoftGraphAPI().request_drive_content(
         method="PUT",
         path=f"{ONEDRIVE_STORE_FOLDER}/{path}",
-        data=json.dumps(d),
+        data=data,
+        headers={"Content-Type": content_type},
     )
 
+    store_stats.add(bytes_uploaded=len(data))
+
     if response.status_code >= 300:
         raise Exception(f"Error uploading store file: {response.text}")
 
+    # The upload responds with the drive item, and the eTag of the new version
+    mirror.save(response.json().get("eTag"), data)
+
     logger.debug(f"Saved store file: {path}")
 
 
+def get_store(path: str) -> dict[str, str]:
+    content = get_store_content(path)
+
+    if content is None:
+        return {}
+
+    return json.loads(content)
+
+
+def save_store(path: str, d: dict | list):
+    save_store_content(path, json.dumps(d).encode())
+
+
 def get_store_with_datetime(path: str) -> dict[str, datetime]:
     d = get_store(path)
     new_data: dict[str, datetime] = {}
@@ -48,12 +194,3 @@ def get_store_with_datetime(path: str) -> dict[str, datetime]:
         new_data[key] = datetime.fromisoformat(value)
 
     return new_data
-
-
-def save_store_with_datetime(path: str, data: dict[str, datetime]):
-    new_data: dict[str, str] = {}
-
-    for key, value in data.items():
-        new_data[key] = value.astimezone().isoformat()
-
-    save_store(path, new_data)
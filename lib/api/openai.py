@@ -1,33 +1,71 @@
-from openai import OpenAI
+import hashlib
+import json
+from collections.abc import Callable
+from functools import cache
+from typing import TYPE_CHECKING, Any
 
+from loguru import logger
+from pydantic import BaseModel
+
+from lib.cache import SQLiteCache
 from lib.env import getenv
 
-openai_client = OpenAI(
-    api_key=getenv("OPENAI_API_KEY"),
-    base_url=getenv("OPENAI_API_BASE_URL", "https://api.openai.com/v1"),
-)
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 extra_headers = {
     "HTTP-Referer": "https://github.com/ckt1031/outlook-summarizer",  # Site URL for rankings on openrouter.ai.
     "X-Title": "Outlook Summarizer",  # Site title for rankings on openrouter.ai.
 }
 model = getenv("OPENAI_API_MODEL", "gpt-4o-mini")
+temperature = 0.5
 
 
-def generate_schema(system_message: str, user_message: str, schema):
-    completion = openai_client.beta.chat.completions.parse(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_message.strip()},
-            {"role": "user", "content": user_message.strip()},
-        ],
-        response_format=schema,
-        temperature=0.5,
-        extra_headers=extra_headers,
+@cache
+def get_openai_client() -> "OpenAI":
+    # The SDK takes most of the start up time, only load it when a completion is needed
+    from openai import OpenAI
+
+    return OpenAI(
+        api_key=getenv("OPENAI_API_KEY"),
+        base_url=getenv("OPENAI_API_BASE_URL", "https://api.openai.com/v1"),
     )
 
-    res = completion.choices[0].message
 
+@cache
+def get_response_cache() -> SQLiteCache:
+    """Responses of previous runs, so a retried batch is not paid for twice"""
+    return SQLiteCache(
+        "llm_responses.sqlite3",
+        max_entries=int(getenv("LLM_CACHE_MAX_ENTRIES", "200")),
+        ttl=float(getenv("LLM_CACHE_TTL_HOURS", "24")) * 60 * 60,
+    )
+
+
+def response_cache_key(
+    system_message: str, user_message: str, schema: type[BaseModel]
+) -> str:
+    request = {
+        "model": model,
+        "temperature": temperature,
+        "system": system_message.strip(),
+        "user": user_message.strip(),
+        "schema": schema.model_json_schema(),
+    }
+
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def schema_messages(system_message: str, user_message: str) -> list[dict]:
+    return [
+        {"role": "system", "content": system_message.strip()},
+        {"role": "user", "content": user_message.strip()},
+    ]
+
+
+def check_schema_response(res, schema: type[BaseModel]) -> BaseModel:
     if not res:
         raise ValueError("No schema response from the model")
 
@@ -38,3 +76,85 @@ def generate_schema(system_message: str, user_message: str, schema):
     schema.model_validate(res.parsed)
 
     return res.parsed
+
+
+def generate_schema(system_message: str, user_message: str, schema: type[BaseModel]):
+    cache_key = response_cache_key(system_message, user_message, schema)
+    cached = get_response_cache().get(cache_key)
+
+    if cached is not None:
+        logger.info("LLM response loaded from cache")
+        return schema.model_validate_json(cached)
+
+    completion = get_openai_client().beta.chat.completions.parse(
+        model=model,
+        messages=schema_messages(system_message, user_message),
+        response_format=schema,
+        temperature=temperature,
+        extra_headers=extra_headers,
+    )
+
+    parsed = check_schema_response(completion.choices[0].message, schema)
+
+    get_response_cache().set(cache_key, parsed.model_dump_json())
+
+    return parsed
+
+
+def stream_schema(
+    system_message: str,
+    user_message: str,
+    schema: type[BaseModel],
+    on_field: Callable[[str, Any], None],
+):
+    """
+    Generate a schema like `generate_schema`, streaming the completion.
+
+    Args:
+        system_message (str): The system prompt.
+        user_message (str): The user prompt.
+        schema (type[BaseModel]): The response model, fields are generated in order.
+        on_field (Callable[[str, Any], None]): Called with the name and value of
+            each top-level field as soon as it is complete.
+
+    Returns:
+        BaseModel: The parsed response.
+    """
+    emitted: set[str] = set()
+
+    def emit(fields: dict):
+        for name in schema.model_fields:
+            if name in fields and name not in emitted:
+                emitted.add(name)
+                on_field(name, fields[name])
+
+    cache_key = response_cache_key(system_message, user_message, schema)
+    cached = get_response_cache().get(cache_key)
+
+    if cached is not None:
+        logger.info("LLM response loaded from cache")
+        parsed = schema.model_validate_json(cached)
+        emit(dict(parsed))
+
+        return parsed
+
+    with get_openai_client().beta.chat.completions.stream(
+        model=model,
+        messages=schema_messages(system_message, user_message),
+        response_format=schema,
+        temperature=temperature,
+        extra_headers=extra_headers,
+    ) as stream:
+        for event in stream:
+            # Partial JSON leaves out unfinished strings, present fields are complete
+            if event.type == "content.delta" and isinstance(event.parsed, dict):
+                emit(event.parsed)
+
+        completion = stream.get_final_completion()
+
+    parsed = check_schema_response(completion.choices[0].message, schema)
+    emit(dict(parsed))
+
+    get_response_cache().set(cache_key, parsed.model_dump_json())
+
+    return parsed
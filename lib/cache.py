@@ -0,0 +1,121 @@
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from lib.env import getenv
+
+
+def get_cache_path(name: str) -> Path:
+    """
+    Get the path of a file in the local cache directory, creating the directory if needed.
+
+    Args:
+        name (str): The file name inside the cache directory.
+
+    Returns:
+        Path: The path of the cache file.
+    """
+    cache_dir = Path(getenv("CACHE_DIR", ".cache"))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return cache_dir / name
+
+
+class SQLiteCache:
+    """
+    Persistent key-value cache in a local SQLite file.
+
+    Entries expire `ttl` seconds after they are written, and the least recently
+    used entries are evicted beyond `max_entries`, on open and whenever a write
+    goes over the limit, so long-lived processes stay bounded too. Hits and
+    misses are counted.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Worker threads share the connection, access is serialised by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(get_cache_path(name), check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+
+        self.evict()
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, str]:
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found: dict[str, str] = {}
+
+        with self.lock, self.connection:
+            # Stay below the SQLite limit of bound parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders}) "
+                    "AND created_at >= ?",
+                    (*chunk, now - self.ttl),
+                ).fetchall()
+                found.update(rows)
+
+            self.connection.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def get(self, key: str) -> str | None:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: dict[str, str]):
+        now = time.time()
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items.items()],
+            )
+
+            (count,) = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+
+            if count > self.max_entries:
+                self._delete_stale()
+
+    def set(self, key: str, value: str):
+        self.set_many({key: value})
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones above the limit"""
+        with self.lock, self.connection:
+            self._delete_stale()
+
+    def _delete_stale(self):
+        # Called with the lock held, inside a transaction
+        self.connection.execute(
+            "DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,)
+        )
+        self.connection.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
@@ -0,0 +1,179 @@
+import asyncio
+import random
+import secrets
+import signal
+import time
+
+from loguru import logger
+
+from lib.env import getenv
+from lib.outlook.summarize import OutlookState, summarize_outlook_async
+
+# Notifications of a burst of emails are gathered into one cycle
+NOTIFICATION_DEBOUNCE_SECONDS = 2
+
+
+def poll_interval() -> float:
+    return float(getenv("DAEMON_INTERVAL_MINUTES", "10")) * 60
+
+
+def next_cycle_delay(polled_at: float) -> float:
+    """
+    Seconds to wait before the next poll, counted from the start of the last one.
+
+    Args:
+        polled_at (float): `time.monotonic()` when the last polling cycle started.
+
+    Returns:
+        float: The remaining interval, plus a random jitter.
+    """
+    jitter = float(getenv("DAEMON_JITTER_SECONDS", "30"))
+
+    # Jitter keeps several instances from polling Graph in lockstep
+    remaining = poll_interval() - (time.monotonic() - polled_at)
+
+    return max(remaining, 0) + random.uniform(0, jitter)
+
+
+async def wait_any(events: list[asyncio.Event], timeout: float):
+    """Wait until one of the events is set, or the timeout is reached"""
+    tasks = [asyncio.create_task(event.wait()) for event in events]
+
+    try:
+        await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def create_push_ingestion(on_notification):
+    """
+    Start the notification receiver, if a public notification URL is set.
+
+    Returns:
+        tuple: The `NotificationReceiver` and the `SubscriptionManager` of its
+            subscription, both None to only poll.
+    """
+    notification_url = getenv("GRAPH_NOTIFICATION_URL", required=False)
+
+    if not notification_url:
+        return None, None
+
+    from lib.outlook.notifications import NotificationReceiver, SubscriptionManager
+
+    # Only notifications of the subscription created by this process are accepted
+    client_state = getenv(
+        "GRAPH_NOTIFICATION_CLIENT_STATE", secrets.token_urlsafe(32), required=False
+    )
+
+    receiver = NotificationReceiver(
+        port=int(getenv("GRAPH_NOTIFICATION_PORT", "8000")),
+        client_state=client_state,
+        on_notification=on_notification,
+    )
+    receiver.start()
+
+    return receiver, SubscriptionManager(notification_url, client_state)
+
+
+async def ensure_subscription(subscriptions):
+    try:
+        await asyncio.to_thread(subscriptions.ensure)
+    except Exception:
+        logger.exception("Inbox subscription failed, new emails are only polled")
+
+
+async def run_cycle(
+    cycle: int, state: OutlookState, message_ids: list[str] | None = None
+):
+    started_at = time.monotonic()
+
+    # A signal during a cycle lets it finish, so its changes are saved
+    try:
+        await summarize_outlook_async(state, message_ids)
+    except Exception:
+        logger.exception(f"Cycle {cycle} failed")
+
+        # The saved state may be partly updated, download it again next cycle
+        state.store, state.delta_link = None, None
+
+    logger.info(f"Cycle {cycle} finished in {time.monotonic() - started_at:.2f}s")
+
+
+def run_daemon():
+    """
+    Summarize Outlook emails in cycles, until SIGTERM or SIGINT.
+
+    The process stays alive between cycles, so the Graph token, HTTP connection
+    pools, caches, email store and delta link are reused instead of being set up
+    again every run. With `GRAPH_NOTIFICATION_URL`, Graph notifies new emails and
+    a cycle fetches them by ID right away, polling the inbox on the interval
+    remains as a fallback for missed notifications.
+    """
+    asyncio.run(run_daemon_async())
+
+
+async def run_daemon_async():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    # Set from the receiver thread when new emails are notified
+    notified = asyncio.Event()
+    receiver, subscriptions = create_push_ingestion(
+        lambda: loop.call_soon_threadsafe(notified.set)
+    )
+
+    state = OutlookState()
+    cycle = 0
+    polled_at = None
+
+    try:
+        while not stop.is_set():
+            cycle += 1
+            started_at = time.monotonic()
+
+            if subscriptions is not None:
+                await ensure_subscription(subscriptions)
+
+            # Emails notified from now on start another cycle after this one
+            notified.clear()
+            notified_ids = receiver.drain() if receiver is not None else []
+
+            # Notified emails are fetched by ID, the inbox is only listed when the
+            # interval is over, which catches any notification Graph did not send
+            poll = (
+                polled_at is None
+                or not notified_ids
+                or started_at - polled_at >= poll_interval()
+            )
+
+            if poll:
+                polled_at = started_at
+                logger.info(f"Starting cycle {cycle}, polling the inbox")
+                await run_cycle(cycle, state)
+            else:
+                logger.info(
+                    f"Starting cycle {cycle}, fetching {len(notified_ids)} "
+                    "notified emails"
+                )
+                await run_cycle(cycle, state, notified_ids)
+
+            delay = next_cycle_delay(polled_at)
+            await wait_any([stop, notified], timeout=delay)
+
+            if notified.is_set() and not stop.is_set():
+                await wait_any([stop], timeout=NOTIFICATION_DEBOUNCE_SECONDS)
+    finally:
+        if receiver is not None:
+            receiver.stop()
+
+        if subscriptions is not None:
+            try:
+                await asyncio.to_thread(subscriptions.close)
+            except Exception:
+                logger.exception("Failed to delete the inbox subscription")
+
+    logger.success(f"Daemon stopped after {cycle} cycles")
@@ -0,0 +1,103 @@
+import asyncio
+from functools import cache
+
+from loguru import logger
+
+from lib.api.openai import generate_schema
+from lib.cache import SQLiteCache
+from lib.env import getenv
+from lib.outlook.prompt import EmailPromptBuilder
+from lib.prompts.email_digest import EmailDigestSchema, email_digest_prompt
+from lib.prompts.email_summary import EmailSummarySchema
+
+# Category of a digest, to the field of the merged summary
+DIGEST_CATEGORY_FIELDS = {
+    "info": "info_summary",
+    "event": "event_summary",
+    "opportunities": "opportunities_summary",
+}
+
+
+@cache
+def get_digest_cache() -> SQLiteCache:
+    """Summaries of single emails by message ID, reused by later runs"""
+    return SQLiteCache(
+        "email_digests.sqlite3",
+        max_entries=int(getenv("DIGEST_CACHE_MAX_ENTRIES", "5000")),
+        ttl=float(getenv("DIGEST_CACHE_TTL_DAYS", "7")) * 24 * 60 * 60,
+    )
+
+
+def digest_email(email: dict) -> EmailDigestSchema:
+    """
+    Map stage: summarize a single email, or load its summary from the cache.
+
+    Args:
+        email (dict): An email from `EmailExtractor`.
+
+    Returns:
+        EmailDigestSchema: The compact summary of the email.
+    """
+    cached = get_digest_cache().get(email["id"])
+
+    if cached is not None:
+        return EmailDigestSchema.model_validate_json(cached)
+
+    prompt_builder = EmailPromptBuilder()
+    prompt_builder.add_email(email)
+
+    digest = generate_schema(
+        system_message=email_digest_prompt,
+        user_message=prompt_builder.build(),
+        schema=EmailDigestSchema,
+    )
+
+    get_digest_cache().set(email["id"], digest.model_dump_json())
+
+    return digest
+
+
+async def adigest_email(email: dict, semaphore: asyncio.Semaphore) -> EmailDigestSchema:
+    async with semaphore:
+        return await asyncio.to_thread(digest_email, email)
+
+
+def reduce_digests(digests: list[EmailDigestSchema]) -> EmailSummarySchema:
+    """
+    Reduce stage: merge email summaries into the categories, without calling the LLM.
+
+    Args:
+        digests (list[EmailDigestSchema]): Summaries of single emails, in delivery order.
+
+    Returns:
+        EmailSummarySchema: The summary of every category.
+    """
+    sections: dict[str, list[str]] = {
+        field: [] for field in DIGEST_CATEGORY_FIELDS.values()
+    }
+    seen: set[tuple[str, str]] = set()
+
+    for digest in digests:
+        title = digest.title.strip().lstrip("#").strip()
+        summary = digest.summary.strip()
+
+        if not digest.relevant or not summary:
+            continue
+
+        # Threads repeat the same content in every reply
+        if (title, summary) in seen:
+            continue
+
+        seen.add((title, summary))
+        sections[DIGEST_CATEGORY_FIELDS[digest.category]].append(
+            f"## {title}\n\n{summary}"
+        )
+
+    logger.debug(
+        f"Reduced {len(digests)} email summaries to {len(seen)} section entries"
+    )
+
+    return EmailSummarySchema(
+        available=len(seen) > 0,
+        **{field: "\n\n".join(entries) for field, entries in sections.items()},
+    )
@@ -1,24 +1,175 @@
-from lib.api.microsoft import MicrosoftGraphAPI
-from lib.utils import process_html_to_text
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Container, Iterator
+from functools import cache
+
+from loguru import logger
+
+from lib.api.microsoft import DeltaTokenExpiredError, MicrosoftGraphAPI
+from lib.api.microsoft_async import AsyncMicrosoftGraphAPI
+from lib.cache import SQLiteCache
+from lib.env import getenv
+from lib.utils import convert_bodies_to_text
+
+
+@cache
+def get_body_cache() -> SQLiteCache:
+    """Text converted in previous runs, threads are fetched again every run"""
+    return SQLiteCache(
+        "email_bodies.sqlite3",
+        max_entries=int(getenv("BODY_CACHE_MAX_ENTRIES", "5000")),
+        ttl=float(getenv("BODY_CACHE_TTL_DAYS", "7")) * 24 * 60 * 60,
+    )
 
 
 class EmailExtractor:
-    def __init__(self):
-        self.api = MicrosoftGraphAPI()
+    def __init__(
+        self, delta_link: str | None = None, message_ids: list[str] | None = None
+    ):
+        # Let Graph convert bodies to text, HTML bodies are still handled as fallback
+        self.api = MicrosoftGraphAPI(body_type=getenv("OUTLOOK_BODY_TYPE", "text"))
+        self.async_api = AsyncMicrosoftGraphAPI(self.api)
+
+        # Only transfer messages changed since the last run with delta queries
+        self.delta_sync = getenv("OUTLOOK_DELTA_SYNC", "true").lower() == "true"
+        self.delta_link = delta_link
+
+        # IDs of emails notified by Graph, fetched instead of listing the inbox
+        self.message_ids = message_ids
+
+        # Number of emails fetched and extracted at a time
+        self.page_size = int(getenv("OUTLOOK_PAGE_SIZE", "50"))
+
+        # Shared by the cycles of a daemon, the connection is opened once
+        self.body_cache = get_body_cache()
+
+    @staticmethod
+    def is_reply(email: dict) -> bool:
+        return "singleValueExtendedProperties" in email
+
+    def iter_id_pages(self) -> Iterator[list[str]]:
+        """First phase: IDs of candidate emails, without downloading any body"""
+        if self.message_ids is not None:
+            # The delta link is left as is, the next poll lists the same changes
+            message_ids = list(dict.fromkeys(self.message_ids))
+
+            for start in range(0, len(message_ids), self.page_size):
+                yield message_ids[start : start + self.page_size]
+
+            return
+
+        if self.delta_sync:
+            try:
+                message_ids, self.delta_link = self.api.fetch_email_ids_delta(
+                    self.delta_link
+                )
+            except DeltaTokenExpiredError:
+                logger.warning("Delta link expired, falling back to time-window fetch")
+
+                # Start a new delta round in the next run
+                self.delta_link = None
+            else:
+                logger.debug(f"Delta sync found {len(message_ids)} changed emails")
+
+                for start in range(0, len(message_ids), self.page_size):
+                    yield message_ids[start : start + self.page_size]
+
+                return
+
+        for page in self.api.iter_email_metadata_pages(self.page_size):
+            yield [email["id"] for email in page]
+
+    @staticmethod
+    def filter_unchecked(
+        message_ids: list[str], checked_ids: Container[str]
+    ) -> list[str]:
+        unchecked_ids = [
+            message_id for message_id in message_ids if message_id not in checked_ids
+        ]
+
+        logger.debug(
+            f"{len(message_ids) - len(unchecked_ids)} emails were checked, "
+            f"fetching {len(unchecked_ids)} new emails"
+        )
+
+        return unchecked_ids
 
-    def extract_emails(self):
+    def reply_conversation_ids(self, fetched_emails: list[dict]) -> list[str]:
+        return [
+            email["conversationId"] for email in fetched_emails if self.is_reply(email)
+        ]
+
+    async def aextract_page(self, fetched_emails: list[dict]) -> list[dict]:
+        # Fetch the replies of all conversations at once, each thread only once
+        conversation_replies = await self.async_api.fetch_replies_batch(
+            self.reply_conversation_ids(fetched_emails)
+        )
+
+        # Convert in a worker thread so the next page can be fetched meanwhile
+        return await asyncio.to_thread(
+            self.build_emails, fetched_emails, conversation_replies
+        )
+
+    @staticmethod
+    def body_cache_key(message: dict) -> str:
+        # The change key is updated whenever the message is modified
+        return ":".join(
+            [
+                message["id"],
+                message.get("changeKey", ""),
+                message["uniqueBody"].get("contentType", "html"),
+            ]
+        )
+
+    def convert_bodies(self, messages: list[dict]) -> dict[str, str]:
+        """
+        Convert message bodies to text, reusing text converted in previous runs.
+
+        Returns:
+            dict[str, str]: Converted text of each message ID.
+        """
+        keys = {message["id"]: self.body_cache_key(message) for message in messages}
+        texts = self.body_cache.get_many(keys.values())
+
+        # Unique bodies missing from the cache, converted in one stage
+        missing = {
+            keys[message["id"]]: message["uniqueBody"]
+            for message in messages
+            if keys[message["id"]] not in texts
+        }
+        converted = dict(
+            zip(missing, convert_bodies_to_text(list(missing.values())), strict=True)
+        )
+        self.body_cache.set_many(converted)
+        texts.update(converted)
+
+        return {message_id: texts[key] for message_id, key in keys.items()}
+
+    def build_emails(
+        self, fetched_emails: list[dict], conversation_replies: dict[str, list[dict]]
+    ) -> list[dict]:
         emails = []
 
-        for email in self.api.fetch_emails():
-            unique_body = process_html_to_text(email["uniqueBody"]["content"])
+        # Convert every body of the page at once, threads share their replies
+        bodies = self.convert_bodies(
+            fetched_emails
+            + [
+                reply
+                for email in fetched_emails
+                if self.is_reply(email)
+                for reply in conversation_replies[email["conversationId"]]
+            ]
+        )
+
+        for email in fetched_emails:
+            unique_body = bodies[email["id"]]
 
             # Replies to the email
             replies_body = None
-            is_reply = "singleValueExtendedProperties" in email
+            is_reply = self.is_reply(email)
 
             # If email is a reply, fetch more details
             if is_reply:
-                replies = self.api.fetch_replies(email["conversationId"])
+                replies = conversation_replies[email["conversationId"]]
 
                 # Remove the original email from the replies, one with the same id
                 replies = [reply for reply in replies if reply["id"] != email["id"]]
@@ -29,7 +180,7 @@ class EmailExtractor:
                         "subject": reply["subject"].strip(),
                         "from": reply["sender"]["emailAddress"]["name"],
                         "date": reply["receivedDateTime"],
-                        "body": process_html_to_text(reply["uniqueBody"]["content"]),
+                        "body": bodies[reply["id"]],
                     }
                     for reply in replies
                 ]
@@ -47,3 +198,43 @@ class EmailExtractor:
             )
 
         return emails
+
+    async def aiter_emails(
+        self, checked_ids: Awaitable[Container[str]]
+    ) -> AsyncIterator[dict]:
+        """
+        Stream extracted emails, listing the next IDs while extracting a page.
+
+        IDs are listed first, then full emails are fetched only for the ones not
+        checked yet, one page at a time.
+
+        `checked_ids` is awaited once the first IDs are listed, so the store can
+        be loaded meanwhile. It must be awaitable more than once, like a task.
+        """
+        id_pages = self.iter_id_pages()
+        next_ids = asyncio.create_task(asyncio.to_thread(next, id_pages, None))
+
+        try:
+            while (message_ids := await next_ids) is not None:
+                next_ids = asyncio.create_task(asyncio.to_thread(next, id_pages, None))
+
+                unchecked_ids = self.filter_unchecked(message_ids, await checked_ids)
+
+                if not unchecked_ids:
+                    continue
+
+                page = await self.async_api.fetch_emails_by_id(unchecked_ids)
+
+                for email in await self.aextract_page(page):
+                    yield email
+        finally:
+            # The listing thread can't be cancelled, let it finish so it does not
+            # change the delta link after the caller read it, then close the pages
+            if not next_ids.done():
+                await asyncio.wait([next_ids])
+
+            # Its IDs or error are not needed any more
+            if not next_ids.cancelled():
+                next_ids.exception()
+
+            await asyncio.to_thread(id_pages.close)
@@ -0,0 +1,219 @@
+import http.server
+import json
+import queue
+import secrets
+import threading
+from collections.abc import Callable
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+from lib.api.microsoft import MicrosoftGraphAPI
+
+# New messages of the inbox
+INBOX_RESOURCE = "me/mailFolders('inbox')/messages"
+
+# Message subscriptions last at most 7 days, renewed when less than a day is left
+SUBSCRIPTION_LIFETIME = timedelta(days=2)
+SUBSCRIPTION_RENEW_MARGIN = timedelta(days=1)
+
+# Graph batches notifications, but a request is never near this size
+MAX_NOTIFICATION_SIZE = 1024 * 1024
+
+
+class NotificationRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the validation requests and change notifications sent by Graph."""
+
+    server: "NotificationServer"
+
+    def do_POST(self):
+        query_components = parse_qs(urlparse(self.path).query)
+        validation_token = query_components.get("validationToken", [None])[0]
+
+        # Graph checks the endpoint by expecting the token back as plain text
+        if validation_token is not None:
+            self.respond(200, validation_token.encode(), "text/plain")
+            return
+
+        # The endpoint is public, a missing or negative length would block the read
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            length = -1
+
+        if length < 0:
+            self.respond(400)
+            return
+
+        if length > MAX_NOTIFICATION_SIZE:
+            self.respond(413)
+            return
+
+        try:
+            notifications = json.loads(self.rfile.read(length)).get("value", [])
+        except (ValueError, AttributeError):
+            notifications = None
+
+        if not isinstance(notifications, list) or not all(
+            isinstance(notification, dict) for notification in notifications
+        ):
+            self.respond(400)
+            return
+
+        # Answered quickly with 202, the emails are processed by the daemon
+        if self.server.receiver.accept(notifications):
+            self.respond(202)
+        else:
+            self.respond(403)
+
+    def respond(self, status: int, body: bytes = b"", content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"Notification receiver: {format % args}")
+
+
+class NotificationServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], receiver: "NotificationReceiver"):
+        super().__init__(address, NotificationRequestHandler)
+        self.receiver = receiver
+
+
+class NotificationReceiver:
+    """
+    Local HTTP endpoint of the inbox subscription.
+
+    Notifications carrying the expected client state queue the IDs of the new
+    messages, and `on_notification` is called to wake the consumer.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        client_state: str,
+        on_notification: Callable[[], None] | None = None,
+        host: str = "",
+    ):
+        self.client_state = client_state
+        self.on_notification = on_notification
+        self.message_ids: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self.httpd = NotificationServer((host, port), self)
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        logger.info(f"Notification receiver listening on port {self.port}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def accept(self, notifications: list[dict]) -> bool:
+        """
+        Queue the messages of a notification request.
+
+        Returns:
+            bool: False if a notification does not carry the client state.
+        """
+        for notification in notifications:
+            client_state = str(notification.get("clientState", ""))
+
+            # Compared as bytes, strings with non-ASCII characters raise TypeError
+            if not secrets.compare_digest(
+                client_state.encode(), self.client_state.encode()
+            ):
+                logger.warning("Rejected a notification with a wrong client state")
+                return False
+
+        for notification in notifications:
+            message_id = (notification.get("resourceData") or {}).get("id")
+
+            if message_id:
+                self.message_ids.put(message_id)
+
+        if notifications and self.on_notification is not None:
+            self.on_notification()
+
+        return True
+
+    def drain(self) -> list[str]:
+        """Take every queued message ID"""
+        message_ids = []
+
+        while not self.message_ids.empty():
+            message_ids.append(self.message_ids.get_nowait())
+
+        return message_ids
+
+
+class SubscriptionManager:
+    """
+    Keeps a Graph subscription to new inbox messages alive.
+
+    Subscriptions left by a previous process are replaced, as their client state
+    is unknown. Polling still runs on its interval, so missed notifications only
+    add latency.
+    """
+
+    def __init__(self, notification_url: str, client_state: str):
+        self.api = MicrosoftGraphAPI()
+        self.notification_url = notification_url
+        self.client_state = client_state
+        self.subscription_id: str | None = None
+        self.expires_at = datetime.min.replace(tzinfo=timezone.utc)
+
+    def ensure(self):
+        """Create the subscription, or renew it when it is about to expire"""
+        now = datetime.now(timezone.utc)
+
+        if (
+            self.subscription_id is not None
+            and self.expires_at - now > SUBSCRIPTION_RENEW_MARGIN
+        ):
+            return
+
+        expires_at = now + SUBSCRIPTION_LIFETIME
+
+        if self.subscription_id is not None:
+            if self.api.renew_subscription(self.subscription_id, expires_at):
+                self.expires_at = expires_at
+                logger.info(f"Renewed the inbox subscription until {expires_at}")
+                return
+
+            logger.warning("The inbox subscription was removed, creating a new one")
+        else:
+            self.remove_stale()
+
+        subscription = self.api.create_subscription(
+            resource=INBOX_RESOURCE,
+            notification_url=self.notification_url,
+            expiration=expires_at,
+            client_state=self.client_state,
+        )
+
+        self.subscription_id = subscription["id"]
+        self.expires_at = expires_at
+        logger.info(f"Subscribed to new inbox messages until {expires_at}")
+
+    def remove_stale(self):
+        for subscription in self.api.list_subscriptions():
+            if subscription.get("notificationUrl") == self.notification_url:
+                self.api.delete_subscription(subscription["id"])
+                logger.debug(f"Deleted stale subscription {subscription['id']}")
+
+    def close(self):
+        if self.subscription_id is None:
+            return
+
+        self.api.delete_subscription(self.subscription_id)
+        self.subscription_id = None
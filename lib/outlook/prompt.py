@@ -0,0 +1,182 @@
+import io
+import os
+import textwrap
+from functools import cache
+
+import tiktoken
+from loguru import logger
+
+from lib.api.openai import model
+from lib.cache import get_cache_path
+from lib.env import getenv
+
+# Encoding of models unknown to tiktoken, e.g. ones served through OpenRouter
+DEFAULT_ENCODING = "o200k_base"
+
+# Characters per token when no encoding can be loaded, low enough to overestimate
+ESTIMATE_CHARS_PER_TOKEN = 3
+
+
+class CharacterEncoding:
+    """Token estimate from the text length, used when tiktoken is unavailable"""
+
+    def encode(self, text: str, disallowed_special=()) -> list[str]:
+        return [
+            text[start : start + ESTIMATE_CHARS_PER_TOKEN]
+            for start in range(0, len(text), ESTIMATE_CHARS_PER_TOKEN)
+        ]
+
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+
+@cache
+def get_encoding() -> tiktoken.Encoding | CharacterEncoding:
+    # tiktoken downloads the BPE file on first use, keep it with the other caches
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(get_cache_path("tiktoken")))
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        # The summary must not fail because the download host is unreachable
+        logger.opt(exception=True).warning(
+            "Failed to load the tiktoken encoding, estimating tokens from characters"
+        )
+
+        return CharacterEncoding()
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    tokens = get_encoding().encode(text, disallowed_special=())
+
+    if len(tokens) <= max_tokens:
+        return text
+
+    return get_encoding().decode(tokens[:max_tokens])
+
+
+class EmailPromptBuilder:
+    """
+    Assemble the user prompt of the email summary in one pass, within a token budget.
+
+    Emails are written to a buffer as they are added and tokens are counted per
+    section. An email whose thread does not fit is rejected, to be added to
+    another prompt. The first email of a prompt is never rejected: its oldest
+    replies are dropped first, then its body is truncated.
+    """
+
+    def __init__(
+        self, current_datetime: str | None = None, token_budget: int | None = None
+    ):
+        if token_budget is None:
+            token_budget = int(getenv("OUTLOOK_PROMPT_TOKEN_BUDGET", "100000"))
+
+        self.token_budget = token_budget
+        self.buffer = io.StringIO()
+        self.token_count = 0
+        self.emails: list[dict] = []
+        self.dropped_replies = 0
+
+        # Prompts of a single email use the email date instead, to stay cacheable
+        if current_datetime is not None:
+            header = f"Current Datetime: {current_datetime}\n\n"
+            self.buffer.write(header)
+            self.token_count += count_tokens(header)
+
+    @staticmethod
+    def format_email(email: dict, body: str | None = None) -> str:
+        # Basic information about the email
+        prompt = (
+            f"Subject: {email['subject']}\nFrom: {email['from']}\nDate: {email['date']}"
+        )
+        # Main body
+        body = email["body"] if body is None else body
+        prompt += f"\n\n--- Main Body START ---\n\n{body}\n\n--- Main Body END ---"
+
+        return prompt
+
+    @staticmethod
+    def format_reply(index: int, reply: dict) -> str:
+        reply_content = f"Subject: {reply['subject']}\nFrom: {reply['from']}\nDate: {reply['date']}\n\n{reply['body']}"
+
+        # Wrap it up
+        reply_content = f"\n\n--- Reply {index} START ---\n\n{reply_content}\n\n--- Reply {index} END ---"
+
+        # Indent the reply content
+        return textwrap.indent(reply_content, "    ")
+
+    @staticmethod
+    def wrap_email(index: int, prompt: str) -> tuple[str, str]:
+        return (
+            f"==== Email {index} START ====\n\n{prompt}",
+            f"\n\n==== Email {index} END ====\n\n",
+        )
+
+    def add_email(self, email: dict) -> bool:
+        """
+        Add an email and its replies to the prompt.
+
+        Args:
+            email (dict): An email from `EmailExtractor`.
+
+        Returns:
+            bool: Whether the email was added, `False` once the budget is reached.
+        """
+        index = len(self.emails) + 1
+        remaining = self.token_budget - self.token_count
+
+        head, tail = self.wrap_email(index, self.format_email(email))
+        email_tokens = count_tokens(head) + count_tokens(tail)
+
+        if email_tokens > remaining:
+            # Cut the body of an email that cannot fit on its own, else it never gets summarized
+            if self.emails:
+                return False
+
+            empty_head, _ = self.wrap_email(index, self.format_email(email, body=""))
+            body_budget = remaining - count_tokens(empty_head) - count_tokens(tail)
+            body = truncate_tokens(email["body"], max(body_budget, 0))
+
+            head, _ = self.wrap_email(index, self.format_email(email, body=body))
+            email_tokens = count_tokens(head) + count_tokens(tail)
+
+            logger.warning(f"Email {email['subject']!r} is truncated to fit the budget")
+
+        # Replies are sorted newest first, keep the newest ones that fit
+        replies = []
+        replies_tokens = 0
+
+        if email["is_reply"]:
+            for reply_index, reply in enumerate(email["replies_body"], start=1):
+                reply_content = self.format_reply(reply_index, reply)
+                reply_tokens = count_tokens(reply_content)
+
+                if email_tokens + replies_tokens + reply_tokens > remaining:
+                    # A new prompt may hold the whole thread, only a first email
+                    # loses replies
+                    if self.emails:
+                        return False
+
+                    self.dropped_replies += len(email["replies_body"]) - len(replies)
+                    break
+
+                replies.append(reply_content)
+                replies_tokens += reply_tokens
+
+        self.buffer.write(head)
+        self.buffer.writelines(replies)
+        self.buffer.write(tail)
+        self.token_count += email_tokens + replies_tokens
+        self.emails.append(email)
+
+        return True
+
+    def build(self) -> str:
+        return self.buffer.getvalue()
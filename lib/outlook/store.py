@@ -1,5 +1,26 @@
+import gzip
+import hashlib
+import json
+import time
 from datetime import datetime, timedelta, timezone
 
+from loguru import logger
+
+from lib.api.onedrive import (
+    get_store_content,
+    get_store_with_datetime,
+    save_store_content,
+)
+
+# Gzipped JSON with the version below, replaces the flat JSON of earlier versions
+EMAIL_STORE_PATH = "email_store.json.gz"
+LEGACY_EMAIL_STORE_PATH = "email_record.json"
+EMAIL_STORE_VERSION = 2
+
+# Checked emails are remembered for this many days
+EMAIL_STORE_RETENTION_DAYS = 7
+SECONDS_PER_DAY = 24 * 60 * 60
+
 
 def prune_email_store(data: dict[str, datetime]) -> dict[str, datetime]:
     """
@@ -14,7 +35,9 @@ def prune_email_store(data: dict[str, datetime]) -> dict[str, datetime]:
         A new dictionary containing only the emails that are not older than 7 days.
     """
     new_dict = {}
-    cutoff_date = datetime.now(timezone.utc) - timedelta(days=7)
+    cutoff_date = datetime.now(timezone.utc) - timedelta(
+        days=EMAIL_STORE_RETENTION_DAYS
+    )
 
     for item_id, value in data.items():
         if value >= cutoff_date:
@@ -22,3 +45,125 @@ def prune_email_store(data: dict[str, datetime]) -> dict[str, datetime]:
             new_dict[item_id] = value
 
     return new_dict
+
+
+class EmailStore:
+    """
+    Checked emails, by a short hash of the message ID, in buckets of the UTC day
+    they were checked on.
+
+    Graph message IDs are long base64 strings, only a 64-bit hash is kept, with
+    the check time in epoch seconds. Pruning drops whole day buckets.
+    """
+
+    def __init__(self, buckets: dict[int, dict[str, int]] | None = None):
+        # Day number since the epoch, to the hashed IDs checked on that day
+        self.buckets: dict[int, dict[str, int]] = buckets or {}
+        # Hashed ID to its bucket, for membership checks
+        self.days: dict[str, int] = {
+            key: day for day, bucket in self.buckets.items() for key in bucket
+        }
+
+    @staticmethod
+    def hash_id(message_id: str) -> str:
+        return hashlib.blake2b(message_id.encode(), digest_size=8).hexdigest()
+
+    def __contains__(self, message_id: object) -> bool:
+        return isinstance(message_id, str) and self.hash_id(message_id) in self.days
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def add(self, message_id: str, checked_at: datetime):
+        key = self.hash_id(message_id)
+        timestamp = int(checked_at.timestamp())
+        day = timestamp // SECONDS_PER_DAY
+
+        # A checked email moves to the bucket of its latest check
+        previous_day = self.days.get(key)
+
+        if previous_day is not None and previous_day != day:
+            del self.buckets[previous_day][key]
+
+        self.buckets.setdefault(day, {})[key] = timestamp
+        self.days[key] = day
+
+    def prune(self, retention_days: int = EMAIL_STORE_RETENTION_DAYS):
+        """
+        Drop the buckets whose emails are all older than the retention period.
+
+        The oldest kept bucket may hold emails up to a day past the retention period.
+        """
+        cutoff = int(time.time()) - retention_days * SECONDS_PER_DAY
+
+        for day in [
+            day for day in self.buckets if (day + 1) * SECONDS_PER_DAY <= cutoff
+        ]:
+            for key in self.buckets.pop(day):
+                del self.days[key]
+
+    def to_bytes(self) -> bytes:
+        data = {
+            "version": EMAIL_STORE_VERSION,
+            "buckets": {
+                str(day): bucket
+                for day, bucket in sorted(self.buckets.items())
+                if bucket
+            },
+        }
+
+        # No timestamp in the gzip header, an unchanged store keeps the same bytes.
+        # Hashed IDs barely compress further above level 6, at twice the time.
+        return gzip.compress(
+            json.dumps(data, separators=(",", ":")).encode(), compresslevel=6, mtime=0
+        )
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "EmailStore":
+        data = json.loads(gzip.decompress(content))
+
+        if data.get("version") != EMAIL_STORE_VERSION:
+            raise Exception(f"Unsupported email store version: {data.get('version')}")
+
+        return cls({int(day): bucket for day, bucket in data["buckets"].items()})
+
+    @classmethod
+    def from_legacy(cls, data: dict[str, datetime]) -> "EmailStore":
+        """Convert the flat `{id: datetime}` store of earlier versions"""
+        store = cls()
+
+        for message_id, checked_at in data.items():
+            store.add(message_id, checked_at)
+
+        return store
+
+
+def load_email_store() -> EmailStore:
+    """
+    Load the store of checked emails, and prune the expired ones.
+
+    The JSON store of earlier versions is migrated when no new store exists yet.
+    """
+    content = get_store_content(EMAIL_STORE_PATH)
+
+    if content is None:
+        legacy = prune_email_store(get_store_with_datetime(LEGACY_EMAIL_STORE_PATH))
+        store = EmailStore.from_legacy(legacy)
+
+        # Saved now, runs without new mail would otherwise read the old store again
+        save_email_store(store)
+
+        if legacy:
+            logger.info(
+                f"Migrated {len(store)} checked emails from {LEGACY_EMAIL_STORE_PATH}"
+            )
+    else:
+        store = EmailStore.from_bytes(content)
+
+    store.prune()
+
+    return store
+
+
+def save_email_store(store: EmailStore):
+    save_store_content(EMAIL_STORE_PATH, store.to_bytes(), "application/gzip")
@@ -1,15 +1,37 @@
-import textwrap
-from datetime import datetime, timezone
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
 
 from loguru import logger
 
-from lib.api.onedrive import get_store_with_datetime, save_store_with_datetime
-from lib.api.openai import generate_schema
+from lib.api.onedrive import get_store, log_store_stats, save_store
 from lib.env import getenv
 from lib.outlook.extractor import EmailExtractor
-from lib.outlook.store import prune_email_store
-from lib.prompts.email_summary import EmailSummarySchema, email_summary_prompt
-from lib.utils import split_text_and_send_to_discord, wrap_all_markdown_link
+from lib.outlook.store import EmailStore, load_email_store, save_email_store
+
+
+def save_delta_link(path: str, old_link: str | None, new_link: str | None):
+    if new_link == old_link:
+        return
+
+    save_store(path, {"delta_link": new_link})
+
+
+@dataclass
+class OutlookState:
+    """Email store and delta link of the last cycle, kept in memory by the daemon"""
+
+    store: EmailStore | None = None
+    delta_link: str | None = None
+
+
+def create_summarizer(
+    current_datetime: str, webhook_urls: dict[str, str], store: EmailStore
+):
+    # Loaded on the first new email, runs without new mail skip the LLM and Discord stacks
+    from lib.outlook.summarizer import EmailSummarizer
+
+    return EmailSummarizer(current_datetime, webhook_urls, store)
 
 
 def summarize_outlook():
@@ -18,103 +40,112 @@ def summarize_outlook():
 
     Debug mode: All emails are passed to the LLM for summarization, saved to local txt files, but it will not send to Discord and save to the database.
     """
+    asyncio.run(summarize_outlook_async())
+
+
+async def summarize_outlook_async(
+    state: OutlookState | None = None, message_ids: list[str] | None = None
+):
+    """
+    Async path of `summarize_outlook`, independent Graph requests overlap.
+
+    Args:
+        state (OutlookState | None): State kept between the cycles of a daemon. The
+            store and delta link it holds are used instead of downloading them, and
+            it is updated once a cycle has saved its changes.
+        message_ids (list[str] | None): IDs of new emails notified by Graph. Only
+            these are fetched, unless checked already, and the inbox is not listed.
+    """
     # Get the webhook URLs
     webhook_url_info = getenv("DISCORD_WEBHOOK_EMAIL_INFO", required=True)
     webhook_url_events = getenv("DISCORD_WEBHOOK_EMAIL_EVENT", required=True)
     webhook_url_program = getenv("DISCORD_WEBHOOK_EMAIL_PROGRAM", required=True)
 
-    # Extract emails
-    emails = EmailExtractor().extract_emails()
+    # Delta link of the last run, saved next to the email store
+    delta_store_path = "email_delta.json"
 
-    # YYYY-MM-DD HH:MM:SS (Day)
-    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S (%A)")
-    email_user_prompt = f"Current Datetime: {current_datetime}\n\n"
+    if state is not None and state.store is not None:
+        state.store.prune()
 
-    store_path = "email_record.json"
-    store = get_store_with_datetime(store_path)
-    # Prune the email store to remove emails older than 7 days
-    store = prune_email_store(store)
+        store_task = asyncio.get_running_loop().create_future()
+        store_task.set_result(state.store)
+        delta_link = state.delta_link
+    else:
+        # The store is only needed to filter emails, load it while they are fetched
+        store_task = asyncio.create_task(asyncio.to_thread(load_email_store))
+        delta_link = (await asyncio.to_thread(get_store, delta_store_path)).get(
+            "delta_link"
+        )
 
-    checking_emails = []
+    # YYYY-MM-DD HH:00 (Day), to the hour so a retried batch hits the LLM cache
+    current_datetime = datetime.now().strftime("%Y-%m-%d %H:00 (%A)")
 
-    # Check if some email is checked
-    for email in emails:
-        checked = email["id"] in store
+    webhook_urls = {
+        "info_summary": webhook_url_info,
+        "event_summary": webhook_url_events,
+        "opportunities_summary": webhook_url_program,
+    }
 
-        if checked:
-            logger.debug(
-                f"Email {email['id']} ({email['subject']}) was checked, skipping"
-            )
-            continue
+    # Created with the first unchecked email
+    summarizer = None
 
-        # Basic information about the email
-        prompt = (
-            f"Subject: {email['subject']}\nFrom: {email['from']}\nDate: {email['date']}"
-        )
-        # Main body
-        prompt += (
-            f"\n\n--- Main Body START ---\n\n{email['body']}\n\n--- Main Body END ---"
-        )
+    # Stream the emails, bodies are only fetched for unchecked ones
+    extractor = EmailExtractor(delta_link=delta_link, message_ids=message_ids)
 
-        if email["is_reply"] and len(email["replies_body"]) > 0:
-            # Add the replies to the email
-            for reply in email["replies_body"]:
-                # Label the reply number for LLM to understand the context
-                index = email["replies_body"].index(reply) + 1
-                reply_content = f"Subject: {reply['subject']}\nFrom: {reply['from']}\nDate: {reply['date']}\n\n{reply['body']}"
-
-                # Wrap it up
-                reply_content = f"\n\n--- Reply {index} START ---\n\n{reply_content}\n\n--- Reply {index} END ---"
+    async for email in extractor.aiter_emails(checked_ids=store_task):
+        if summarizer is None:
+            # Already loaded to filter this email, batches are marked in it once sent
+            summarizer = create_summarizer(
+                current_datetime, webhook_urls, await store_task
+            )
 
-                # Indent the reply content
-                prompt += textwrap.indent(reply_content, "    ")
+        summarizer.add_email(email)
 
-        index = len(checking_emails) + 1
-        email_user_prompt += f"==== Email {index} START ====\n\n{prompt}\n\n==== Email {index} END ====\n\n"
+    store = await store_task
 
-        checking_emails.append(email)
+    logger.info(
+        f"Email body cache: {extractor.body_cache.hits} hits, "
+        f"{extractor.body_cache.misses} misses"
+    )
 
     # If there are no unchecked emails, exit the program
-    if len(checking_emails) == 0:
+    if summarizer is None:
+        await asyncio.to_thread(
+            save_delta_link, delta_store_path, delta_link, extractor.delta_link
+        )
+        log_store_stats()
         logger.success("No new emails to summarize")
-        return
 
-    # Call the LLM model to summarize the emails
-    llm_response = generate_schema(
-        system_message=email_summary_prompt,
-        user_message=email_user_prompt,
-        schema=EmailSummarySchema,
-    )
+        if state is not None:
+            state.store, state.delta_link = store, extractor.delta_link
 
-    if llm_response.available:
-        categorized_summaries_data = [
-            [llm_response.info_summary, webhook_url_info],
-            [llm_response.event_summary, webhook_url_events],
-            [llm_response.opportunities_summary, webhook_url_program],
-        ]
-
-        for data in categorized_summaries_data:
-            summary = data[0]
-            webhook_url = data[1]
-
-            # Skip if the summary is empty
-            if summary is None or len(summary) == 0:
-                logger.warning("Summary is empty, skipping")
-                continue
-
-            # Process the summary text
-            summary = wrap_all_markdown_link(summary)
-
-            # Send the summary to Discord
-            split_text_and_send_to_discord(summary.strip(), webhook_url)
+        return
 
-            logger.success("Discord webhook sent successfully")
+    failed_count = None
+
+    try:
+        failed_count = await summarizer.summarize()
+    finally:
+        # Keep the old delta link unless every batch succeeded, unchecked emails
+        # must be listed again
+        new_delta_link = extractor.delta_link if failed_count == 0 else delta_link
+
+        # Save the store even if the delivery failed, only the emails of delivered
+        # summaries are marked in it
+        await asyncio.gather(
+            asyncio.to_thread(save_email_store, store),
+            asyncio.to_thread(
+                save_delta_link, delta_store_path, delta_link, new_delta_link
+            ),
+        )
 
-    # Mark and save database after all actions to prevent missing emails if the program crashes
-    for email in checking_emails:
-        store[email["id"]] = datetime.now(tz=timezone.utc)
+        log_store_stats()
+        logger.info(f"{summarizer.checked_count} Outlook emails are checked")
 
-    # Save the email store
-    save_store_with_datetime(store_path, store)
+        if state is not None:
+            state.store, state.delta_link = store, new_delta_link
 
-    logger.success(f"{len(checking_emails)} Outlook emails are checked")
+    if failed_count:
+        raise Exception(
+            f"{failed_count} of {len(summarizer.batches)} summary batches failed"
+        )
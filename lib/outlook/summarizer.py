@@ -0,0 +1,304 @@
+import asyncio
+from collections.abc import Coroutine
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from loguru import logger
+
+from lib.api.openai import generate_schema, stream_schema
+from lib.env import getenv
+from lib.outlook.digest import adigest_email, get_digest_cache, reduce_digests
+from lib.outlook.prompt import EmailPromptBuilder
+from lib.outlook.store import EmailStore
+from lib.prompts.email_summary import EmailSummarySchema, email_summary_prompt
+from lib.utils import split_text_and_send_to_discord, wrap_all_markdown_link
+
+
+class SummaryDeliveryError(Exception):
+    """
+    A summary was generated, but not every category reached Discord.
+
+    The emails of the batch are left unchecked, so the next run sends the whole
+    summary again. Categories that were already posted may be posted twice, but
+    none is lost.
+    """
+
+
+def merge_summaries(responses: list[EmailSummarySchema]) -> EmailSummarySchema:
+    """
+    Merge the summaries of several batches, category by category, in batch order.
+    """
+    available = [response for response in responses if response.available]
+
+    def merge(field: str) -> str:
+        summaries = [getattr(response, field).strip() for response in available]
+        return "\n\n".join(summary for summary in summaries if summary)
+
+    return EmailSummarySchema(
+        available=len(available) > 0,
+        info_summary=merge("info_summary"),
+        event_summary=merge("event_summary"),
+        opportunities_summary=merge("opportunities_summary"),
+    )
+
+
+def send_summary(summary: str | None, webhook_url: str):
+    # Skip if the summary is empty
+    if summary is None or len(summary) == 0:
+        logger.warning("Summary is empty, skipping")
+        return
+
+    # Process the summary text
+    summary = wrap_all_markdown_link(summary)
+
+    # Send the summary to Discord
+    split_text_and_send_to_discord(summary.strip(), webhook_url)
+
+    logger.success("Discord webhook sent successfully")
+
+
+async def summarize_batch(
+    prompt_builder: EmailPromptBuilder,
+    semaphore: asyncio.Semaphore,
+    webhook_urls: dict[str, str] | None = None,
+) -> EmailSummarySchema:
+    """
+    Summarize a batch of emails.
+
+    Args:
+        prompt_builder (EmailPromptBuilder): The prompt of the batch.
+        semaphore (asyncio.Semaphore): Limit of LLM calls in flight.
+        webhook_urls (dict[str, str] | None): Webhook of each summary field. If
+            given, the completion is streamed and each category is sent as soon
+            as its field is complete.
+
+    Returns:
+        EmailSummarySchema: The summary of the batch.
+    """
+    logger.info(
+        f"Prompt has {len(prompt_builder.emails)} emails and "
+        f"{prompt_builder.token_count} tokens (budget {prompt_builder.token_budget}), "
+        f"{prompt_builder.dropped_replies} replies dropped"
+    )
+
+    email_user_prompt = prompt_builder.build()
+
+    if webhook_urls is None:
+        async with semaphore:
+            # Call the LLM model to summarize the emails
+            return await asyncio.to_thread(
+                generate_schema,
+                system_message=email_summary_prompt,
+                user_message=email_user_prompt,
+                schema=EmailSummarySchema,
+            )
+
+    def stream_and_send() -> EmailSummarySchema:
+        # `available` is generated first, then the categories in delivery order
+        available = False
+        deliveries: list[Future] = []
+
+        def on_field(name: str, value):
+            nonlocal available
+
+            if name == "available":
+                available = value
+            elif available:
+                deliveries.append(pool.submit(send_summary, value, webhook_urls[name]))
+
+        # Categories are sent in other threads, so the stream keeps being read.
+        # Leaving the pool waits for every delivery, even when the stream failed.
+        try:
+            with ThreadPoolExecutor(max_workers=len(webhook_urls)) as pool:
+                response = stream_schema(
+                    system_message=email_summary_prompt,
+                    user_message=email_user_prompt,
+                    schema=EmailSummarySchema,
+                    on_field=on_field,
+                )
+        except Exception as e:
+            # Reported apart from LLM failures, some categories are already posted
+            if any(delivery.exception() is None for delivery in deliveries):
+                raise SummaryDeliveryError(
+                    "The summary stream failed after some categories were sent"
+                ) from e
+
+            raise
+
+        errors = [
+            delivery.exception()
+            for delivery in deliveries
+            if delivery.exception() is not None
+        ]
+
+        if errors:
+            raise SummaryDeliveryError(
+                f"{len(errors)} of {len(deliveries)} categories failed to send"
+            ) from errors[0]
+
+        return response
+
+    async with semaphore:
+        return await asyncio.to_thread(stream_and_send)
+
+
+class EmailSummarizer:
+    """
+    Summarize emails as they are streamed, and send the summaries to Discord.
+
+    Emails are split into batches that fit the prompt token budget, each batch is
+    summarized as soon as it is full, while the next one is being extracted. The
+    emails of a batch are marked in the store once its summary is delivered.
+    """
+
+    def __init__(
+        self, current_datetime: str, webhook_urls: dict[str, str], store: EmailStore
+    ):
+        self.current_datetime = current_datetime
+        # Webhook of each summary field
+        self.webhook_urls = webhook_urls
+        # Delivered emails are marked in it, saved by the caller even on failure
+        self.store = store
+        self.checked_count = 0
+
+        # Maximum number of LLM calls in flight at once
+        self.semaphore = asyncio.Semaphore(int(getenv("LLM_MAX_CONCURRENCY", "4")))
+
+        # "batch" summarizes prompts of many emails, "map_reduce" summarizes every
+        # email on its own, cached by message ID, then merges them without the LLM
+        self.map_reduce = getenv("OUTLOOK_SUMMARY_MODE", "batch") == "map_reduce"
+
+        # Stream the completion and send each category as soon as it is generated
+        self.stream_delivery = (
+            getenv("OUTLOOK_STREAM_DELIVERY", "false").lower() == "true"
+        )
+        self.streamed = False
+
+        if self.map_reduce:
+            # Open the cache once here, before the worker threads share it
+            self.digest_cache = get_digest_cache()
+
+        # Emails of each batch, with the task summarizing them
+        self.batches: list[list[dict]] = []
+        self.batch_tasks: list[asyncio.Task] = []
+
+        self.prompt_builder = EmailPromptBuilder(current_datetime)
+
+    def submit_batch(self, emails: list[dict], coroutine: Coroutine):
+        self.batches.append(emails)
+        self.batch_tasks.append(asyncio.create_task(coroutine))
+
+    def mark_checked(self, emails: list[dict]):
+        checked_at = datetime.now(tz=timezone.utc)
+
+        for email in emails:
+            self.store.add(email["id"], checked_at)
+
+        self.checked_count += len(emails)
+
+    def add_email(self, email: dict):
+        if self.map_reduce:
+            self.submit_batch([email], adigest_email(email, self.semaphore))
+            return
+
+        if self.prompt_builder.add_email(email):
+            return
+
+        # The batch is full, summarize it while the next one is assembled
+        self.submit_batch(
+            self.prompt_builder.emails,
+            summarize_batch(self.prompt_builder, self.semaphore),
+        )
+
+        self.prompt_builder = EmailPromptBuilder(self.current_datetime)
+        self.prompt_builder.add_email(email)
+
+    async def summarize(self) -> int:
+        """
+        Wait for every batch and send the merged summary to Discord.
+
+        Emails of the summarized batches are marked as checked once the summary
+        is delivered. Failed batches are left unchecked for the next run.
+
+        Returns:
+            int: The number of failed batches.
+
+        Raises:
+            SummaryDeliveryError: If a summary was not fully sent, after every
+                channel was tried. No email is marked as checked.
+        """
+        if self.prompt_builder.emails:
+            # Only a single batch can be sent while generated, more must be merged first
+            self.streamed = self.stream_delivery and not self.batches
+
+            self.submit_batch(
+                self.prompt_builder.emails,
+                summarize_batch(
+                    self.prompt_builder,
+                    self.semaphore,
+                    self.webhook_urls if self.streamed else None,
+                ),
+            )
+
+        logger.info(f"Summarizing emails in {len(self.batches)} batches")
+
+        results = await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+
+        responses = []
+        summarized_batches: list[list[dict]] = []
+        delivery_errors: list[Exception] = []
+        failed_count = 0
+
+        for index, (emails, result) in enumerate(
+            zip(self.batches, results, strict=True), start=1
+        ):
+            if isinstance(result, SummaryDeliveryError):
+                delivery_errors.append(result)
+            elif isinstance(result, Exception):
+                failed_count += 1
+                logger.opt(exception=result).error(
+                    f"Batch {index} of {len(self.batches)} failed"
+                )
+            else:
+                responses.append(result)
+                summarized_batches.append(emails)
+
+        if self.map_reduce:
+            logger.info(
+                f"Email summary cache: {self.digest_cache.hits} hits, "
+                f"{self.digest_cache.misses} misses"
+            )
+
+            llm_response = reduce_digests(responses)
+        else:
+            llm_response = merge_summaries(responses)
+
+        # Streamed categories were sent while the summary was generated
+        if llm_response.available and not self.streamed:
+            # Channels are sent concurrently, messages of a channel stay in order
+            sent = await asyncio.gather(
+                *(
+                    asyncio.to_thread(
+                        send_summary, getattr(llm_response, field), webhook_url
+                    )
+                    for field, webhook_url in self.webhook_urls.items()
+                ),
+                return_exceptions=True,
+            )
+            delivery_errors.extend(
+                result for result in sent if isinstance(result, Exception)
+            )
+
+        if delivery_errors:
+            for error in delivery_errors:
+                logger.opt(exception=error).error("Failed to send a summary")
+
+            raise SummaryDeliveryError(
+                f"{len(delivery_errors)} summaries failed to send"
+            ) from delivery_errors[0]
+
+        # Marked only once delivered, so a failed delivery is retried by the next run
+        for emails in summarized_batches:
+            self.mark_checked(emails)
+
+        return failed_count
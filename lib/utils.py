@@ -1,14 +1,116 @@
+import atexit
+import multiprocessing
+import os
 import re
 import urllib.parse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 
-from html2text import HTML2Text
-from langchain_text_splitters import (
-    MarkdownHeaderTextSplitter,
-    RecursiveCharacterTextSplitter,
-)
 from loguru import logger
 
-from lib.api.discord import send_discord_webhook
+from lib.env import getenv
+
+if TYPE_CHECKING:
+    from html2text import HTML2Text
+
+# Below this many HTML bodies, starting the pool costs more than it saves
+PARALLEL_CONVERSION_THRESHOLD = 16
+
+conversion_pool: ProcessPoolExecutor | None = None
+
+# Discord limits of a webhook message
+DISCORD_MESSAGE_LIMIT = 2000
+DISCORD_EMBED_DESCRIPTION_LIMIT = 4096
+DISCORD_EMBEDS_PER_MESSAGE = 10
+DISCORD_EMBEDS_TOTAL_LIMIT = 6000
+
+# Headers that start a new section, longest first
+MARKDOWN_HEADER_MARKERS = ("###", "##")
+# Separators of text chunks, coarsest first
+TEXT_SEPARATORS = ("\n\n", "\n", " ", "")
+
+
+# One pattern for every normalisation, so the text is scanned a single time.
+# Character classes stop at delimiters, the scan never backtracks over a line.
+# Link texts may nest one level of brackets (`[[1]](...)`) and link URLs one
+# level of parentheses (`.../wiki/Mercury_(planet)`).
+NORMALIZE_PATTERN = re.compile(
+    r"(?P<blank>^[^\S\n]*(?:\n|\Z))"
+    r"|(?P<link>\[(?P<link_text>(?:[^\[\]\n]|\[[^\[\]\n]*\])*)\]"
+    r"\((?P<link_url>(?:[^()\s]|\([^()\s]*\))*)\))"
+    r"|(?P<url>https?://[^\s/<>()\[\]\"']*safelinks\.protection\.outlook\.com"
+    r"[^\s<>()\[\]\"']*)",
+    re.MULTILINE,
+)
+
+SAFELINKS_HOST = "safelinks.protection.outlook.com"
+
+
+def decode_safelink(url: str) -> str:
+    """
+    Decode a Safe Links URL to its original URL with URL parsing.
+
+    Args:
+        url (str): Any URL.
+
+    Returns:
+        str: The original URL, or `url` unchanged if it is not a valid Safe Link.
+    """
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return url
+
+    if not (parts.hostname or "").endswith(SAFELINKS_HOST):
+        return url
+
+    original_url = urllib.parse.parse_qs(parts.query).get("url")
+
+    return original_url[0] if original_url else url
+
+
+def normalize_text(
+    text: str,
+    drop_blank_lines: bool = True,
+    decode_safelinks: bool = True,
+    wrap_links: bool = False,
+) -> str:
+    """
+    Normalise text in one linear pass.
+
+    Args:
+        text (str): The text to normalise.
+        drop_blank_lines (bool): Remove empty and whitespace-only lines.
+        decode_safelinks (bool): Replace Safe Links URLs with their original URLs.
+        wrap_links (bool): Wrap markdown link URLs in `<>` so Discord shows no embeds.
+
+    Returns:
+        str: The normalised text.
+    """
+
+    def replace(match: re.Match) -> str:
+        if match.group("blank") is not None:
+            return "" if drop_blank_lines else match.group(0)
+
+        if match.group("url") is not None:
+            url = match.group("url")
+            return decode_safelink(url) if decode_safelinks else url
+
+        url = match.group("link_url")
+
+        if decode_safelinks:
+            url = decode_safelink(url)
+
+        if wrap_links and not url.startswith("<"):
+            url = f"<{url}>"
+
+        return f"[{match.group('link_text')}]({url})"
+
+    text = NORMALIZE_PATTERN.sub(replace, text)
+
+    # The last kept line has no line break after it
+    return text.rstrip("\n") if drop_blank_lines else text
 
 
 def wrap_all_markdown_link(text: str) -> str:
@@ -21,91 +123,402 @@ def wrap_all_markdown_link(text: str) -> str:
     Returns:
         str: The wrapped text.
     """
-    import re
-
-    return re.sub(
-        r"(\[.*?\]\()(.*?)(\))",
-        lambda m: f"{m.group(1)}<{m.group(2)}>{m.group(3)}",
-        text,
+    return normalize_text(
+        text, drop_blank_lines=False, decode_safelinks=False, wrap_links=True
     )
 
 
-def split_text_and_send_to_discord(text: str, webhook_url: str):
-    headers_to_split_on = [
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-    ]
-    markdown_splitter = MarkdownHeaderTextSplitter(
-        strip_headers=False,
-        headers_to_split_on=headers_to_split_on,
-    )
-    result = markdown_splitter.split_text(text)
+def split_markdown_sections(text: str) -> list[str]:
+    """
+    Split markdown text into sections at the `##` and `###` headers.
 
-    chunk_size = 1900
-    chunk_overlap = 100
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
-    )
+    Same output as langchain's `MarkdownHeaderTextSplitter` keeping the headers:
+    lines are stripped, and the paragraphs of a section are joined by `"  \\n"`.
+
+    Args:
+        text (str): The markdown text.
+
+    Returns:
+        list[str]: The sections, each starting with its header if any.
+    """
+    # (headers of the line, content) for each paragraph
+    paragraphs: list[tuple[dict[int, str], str]] = []
+    content: list[str] = []
+    content_headers: dict[int, str] = {}
+
+    # Levels of the headers the line is under, and their text
+    header_levels: list[int] = []
+    headers: dict[int, str] = {}
+
+    code_fence = ""
+
+    for line in text.split("\n"):
+        line = "".join(filter(str.isprintable, line.strip()))
+
+        # Headers are not parsed inside code blocks
+        if not code_fence:
+            if line.startswith("```") and line.count("```") == 1:
+                code_fence = "```"
+            elif line.startswith("~~~"):
+                code_fence = "~~~"
+        elif line.startswith(code_fence):
+            code_fence = ""
+
+        if code_fence:
+            content.append(line)
+            continue
+
+        level = next(
+            (
+                len(marker)
+                for marker in MARKDOWN_HEADER_MARKERS
+                if line.startswith(marker)
+                and (len(line) == len(marker) or line[len(marker)] == " ")
+            ),
+            None,
+        )
+
+        if level is not None:
+            # A header closes the headers of the same or a deeper level
+            while header_levels and header_levels[-1] >= level:
+                headers.pop(header_levels.pop(), None)
+
+            header_levels.append(level)
+            headers[level] = line[level:].strip()
 
-    result = text_splitter.split_documents(result)
+            if content:
+                paragraphs.append((content_headers.copy(), "\n".join(content)))
+                content.clear()
 
-    for split in result:
-        send_discord_webhook(webhook_url, message=split.page_content, username="Email")
+            content.append(line)
+        elif line:
+            content.append(line)
+        elif content:
+            paragraphs.append((content_headers.copy(), "\n".join(content)))
+            content.clear()
 
+        content_headers = headers.copy()
 
-def remove_excessive_new_lines(text: str) -> str:
-    return "\n".join([line for line in text.split("\n") if line.strip()])
+    if content:
+        paragraphs.append((content_headers, "\n".join(content)))
 
+    # Join the paragraphs under the same headers into sections
+    sections: list[list] = []
 
-def replace_safe_link(match: re.Match) -> str:
+    for paragraph_headers, paragraph in paragraphs:
+        if sections and sections[-1][0] == paragraph_headers:
+            sections[-1][1] += "  \n" + paragraph
+        elif (
+            sections
+            and len(sections[-1][0]) < len(paragraph_headers)
+            and sections[-1][1].split("\n")[-1].startswith("#")
+        ):
+            # A header directly followed by a deeper header stays in its section
+            sections[-1][1] += "  \n" + paragraph
+            sections[-1][0] = paragraph_headers
+        else:
+            sections.append([paragraph_headers, paragraph])
+
+    return [section for _, section in sections]
+
+
+def split_keeping_separator(text: str, separator: str) -> list[str]:
+    if not separator:
+        return list(text)
+
+    parts = text.split(separator)
+    splits = [parts[0]] + [separator + part for part in parts[1:]]
+
+    return [split for split in splits if split]
+
+
+def merge_splits(splits: list[str], chunk_size: int, chunk_overlap: int) -> list[str]:
+    """Merge consecutive splits into chunks, repeating up to `chunk_overlap` chars"""
+    chunks: list[str] = []
+    current: deque[str] = deque()
+    total = 0
+
+    for split in splits:
+        if total + len(split) > chunk_size and current:
+            chunk = "".join(current).strip()
+
+            if chunk:
+                chunks.append(chunk)
+
+            # Keep the end of the chunk as the overlap of the next one
+            while total > chunk_overlap or (
+                total + len(split) > chunk_size and total > 0
+            ):
+                total -= len(current.popleft())
+
+        current.append(split)
+        total += len(split)
+
+    chunk = "".join(current).strip()
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def split_text(
+    text: str,
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    separators: tuple[str, ...] = TEXT_SEPARATORS,
+) -> list[str]:
     """
-    Callback function for re.sub.  Decodes the matched Safe Link and returns
-    the original URL or the Safe Link if decoding fails.
+    Split text into chunks at paragraph, line and word boundaries.
+
+    Same output as langchain's `RecursiveCharacterTextSplitter` with its default
+    separators, which are kept at the start of the next chunk.
+
+    Args:
+        text (str): The text to split.
+        chunk_size (int): Maximum length of a chunk.
+        chunk_overlap (int): Maximum length repeated from the previous chunk.
+        separators (tuple[str, ...]): Separators to try, coarsest first.
+
+    Returns:
+        list[str]: The stripped chunks.
     """
-    # Check if the match is valid and has a group.
-    if match is None or match.lastindex is None:
-        return match.group(0)
+    # Split at the coarsest separator found in the text
+    separator = separators[-1]
+    finer_separators: tuple[str, ...] = ()
 
-    safe_link = match.group(1)
+    for index, candidate in enumerate(separators):
+        if not candidate:
+            separator = candidate
+            break
 
-    # Decode the Safe Link URL.
-    try:
-        return urllib.parse.unquote(safe_link)
-    except Exception as e:
-        logger.warning(f"Failed to decode Safe Link: {safe_link}", e)
+        if candidate in text:
+            separator = candidate
+            finer_separators = separators[index + 1 :]
+            break
+
+    chunks: list[str] = []
+    short_splits: list[str] = []
+
+    for split in split_keeping_separator(text, separator):
+        if len(split) < chunk_size:
+            short_splits.append(split)
+            continue
 
-        # Return the original Safe Link if decoding fails.
-        return safe_link
+        if short_splits:
+            chunks.extend(merge_splits(short_splits, chunk_size, chunk_overlap))
+            short_splits = []
 
+        # Split long parts again at finer separators
+        if finer_separators:
+            chunks.extend(
+                split_text(split, chunk_size, chunk_overlap, finer_separators)
+            )
+        else:
+            chunks.append(split)
+
+    if short_splits:
+        chunks.extend(merge_splits(short_splits, chunk_size, chunk_overlap))
+
+    return chunks
+
+
+def split_sections(sections: list[str], limit: int) -> list[str]:
+    # Only sections longer than the limit are split, without overlap
+    return [
+        piece
+        for section in sections
+        for piece in (
+            [section] if len(section) <= limit else split_text(section, limit)
+        )
+    ]
 
-def convert_safelinks_from_text(text: str) -> str:
+
+def pack_discord_messages(text: str) -> list[dict]:
     """
-    Converts Safe Links URLs found within a plain text string to their original URLs.
+    Pack markdown text into as few Discord message payloads as possible.
 
     Args:
-        text: The input text string potentially containing Safe Links URLs.
+        text (str): The markdown text.
 
     Returns:
-        The text string with Safe Links URLs replaced by their original URLs.
-        If a Safe Link cannot be decoded, it is left unchanged.
+        list[dict]: `send_discord_webhook` arguments, each up to 2000 characters.
     """
+    payloads: list[dict] = []
+    message = ""
 
-    # Regular expression to match Safe Links URLs.  This is improved for robustness.
-    safe_link_pattern = (
-        r"https?:\/\/.*safelinks\.protection\.outlook\.com\/\\?.*[?&]url=([^&]*)&"
-    )
+    for piece in split_sections(split_markdown_sections(text), DISCORD_MESSAGE_LIMIT):
+        candidate = f"{message}\n\n{piece}" if message else piece
 
-    # Use re.sub to find all Safe Links and replace them with the decoded URLs.
-    return re.sub(safe_link_pattern, replace_safe_link, text)
+        if len(candidate) <= DISCORD_MESSAGE_LIMIT:
+            message = candidate
+            continue
 
+        payloads.append({"message": message})
+        message = piece
 
-def process_html_to_text(html: str) -> str:
+    if message:
+        payloads.append({"message": message})
+
+    return payloads
+
+
+def pack_discord_embeds(text: str) -> list[dict]:
+    """
+    Pack markdown text into embeds, filling every payload up to the embed limits.
+
+    Args:
+        text (str): The markdown text.
+
+    Returns:
+        list[dict]: `send_discord_webhook` arguments, each with up to 10 embeds of
+            4096 characters and 6000 characters in total.
+    """
+    # Descriptions of the embeds of each payload
+    payloads: list[list[str]] = [[]]
+
+    for piece in split_sections(
+        split_markdown_sections(text), DISCORD_EMBED_DESCRIPTION_LIMIT
+    ):
+        descriptions = payloads[-1]
+        total = sum(len(description) for description in descriptions)
+
+        if (
+            descriptions
+            and len(descriptions[-1]) + 2 + len(piece)
+            <= DISCORD_EMBED_DESCRIPTION_LIMIT
+            and total + 2 + len(piece) <= DISCORD_EMBEDS_TOTAL_LIMIT
+        ):
+            descriptions[-1] += f"\n\n{piece}"
+        elif (
+            len(descriptions) < DISCORD_EMBEDS_PER_MESSAGE
+            and total + len(piece) <= DISCORD_EMBEDS_TOTAL_LIMIT
+        ):
+            descriptions.append(piece)
+        else:
+            payloads.append([piece])
+
+    return [
+        {"embeds": [{"description": description} for description in descriptions]}
+        for descriptions in payloads
+        if descriptions
+    ]
+
+
+def split_text_and_send_to_discord(text: str, webhook_url: str):
+    from lib.api.discord import send_discord_webhook
+
+    use_embeds = getenv("DISCORD_USE_EMBEDS", "false").lower() == "true"
+
+    if use_embeds:
+        payloads = pack_discord_embeds(text)
+    else:
+        payloads = pack_discord_messages(text)
+
+    logger.debug(f"Packed into {len(payloads)} Discord requests")
+
+    for payload in payloads:
+        send_discord_webhook(webhook_url, username="Email", **payload)
+
+
+def create_html_converter() -> "HTML2Text":
+    # Imported here, runs without HTML bodies to convert never load html2text
+    from html2text import HTML2Text
+
+    # HTML2Text keeps parser state between documents, so one is needed per body
     txt = HTML2Text(bodywidth=0)
     txt.ignore_emphasis = True
     txt.ignore_images = True
 
-    final_text = txt.handle(html)
-    final_text = remove_excessive_new_lines(final_text)
-    final_text = convert_safelinks_from_text(final_text)
+    return txt
 
-    return final_text
+
+def process_html_to_text(html: str) -> str:
+    txt = create_html_converter()
+
+    return normalize_text(txt.handle(html))
+
+
+def process_plain_text(text: str) -> str:
+    """
+    Clean up a body already converted to plain text by Graph, no HTML parsing needed.
+    """
+    return normalize_text(text)
+
+
+def process_body_to_text(body: dict) -> str:
+    """
+    Convert a Graph `itemBody` to plain text.
+
+    Args:
+        body (dict): The body with `contentType` and `content`.
+
+    Returns:
+        str: The plain text, HTML bodies go through the slower HTML pipeline.
+    """
+    if body.get("contentType") == "text":
+        return process_plain_text(body["content"])
+
+    return process_html_to_text(body["content"])
+
+
+def get_conversion_workers() -> int:
+    # Only count the CPUs this process may run on
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+
+    return int(getenv("CONVERSION_WORKERS", str(cpu_count)))
+
+
+def get_conversion_pool() -> ProcessPoolExecutor:
+    """Process pool for body conversion, started once and reused by later pages"""
+    global conversion_pool
+
+    if conversion_pool is None:
+        # Spawn, as forking a process that runs threads can deadlock the workers.
+        # Workers import html2text with their first body, and build a converter
+        # per body as it keeps parser state between documents.
+        conversion_pool = ProcessPoolExecutor(
+            max_workers=get_conversion_workers(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        atexit.register(shutdown_conversion_pool)
+
+    return conversion_pool
+
+
+def shutdown_conversion_pool():
+    """Stop the workers, a later conversion starts a new pool"""
+    global conversion_pool
+
+    if conversion_pool is not None:
+        conversion_pool.shutdown()
+        conversion_pool = None
+
+
+def convert_bodies_to_text(bodies: list[dict]) -> list[str]:
+    """
+    Convert many Graph `itemBody` values to plain text, in parallel when worth it.
+
+    Args:
+        bodies (list[dict]): The bodies with `contentType` and `content`.
+
+    Returns:
+        list[str]: The plain text of each body, in the same order.
+    """
+    html_count = sum(1 for body in bodies if body.get("contentType") != "text")
+    workers = get_conversion_workers()
+
+    if workers <= 1 or html_count < PARALLEL_CONVERSION_THRESHOLD:
+        return [process_body_to_text(body) for body in bodies]
+
+    logger.debug(f"Converting {html_count} HTML bodies in {workers} processes")
+
+    # Map keeps the order of the bodies
+    chunksize = max(1, len(bodies) // (workers * 4))
+
+    return list(
+        get_conversion_pool().map(process_body_to_text, bodies, chunksize=chunksize)
+    )
@@ -9,4 +9,10 @@ logger.remove()
 logger.add(sys.stdout, format="{time}: [<level>{level}</level>] {message}")
 
 if __name__ == "__main__":
-    summarize_outlook()
+    # `python main.py daemon` keeps running, otherwise a single run is done
+    if sys.argv[1:] == ["daemon"]:
+        from lib.outlook.daemon import run_daemon
+
+        run_daemon()
+    else:
+        summarize_outlook()